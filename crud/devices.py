@@ -1,11 +1,19 @@
-from sqlalchemy.orm import Session
-from datetime import datetime, time
-import pandas as pd
-import plotly.express as px
+from sqlalchemy import Float, String, case, column, func, insert, literal, select, tuple_, union_all, update, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session, selectinload
+from datetime import datetime, time, timedelta, timezone
+from typing import List, Optional
+import json
+import numpy as np
 
 from db import models
 from schema import devices
-from db.database import engine
+from crud import rollups
+from utils.config import settings
+from utils.pagination import encode_cursor
+from utils.downsample import downsample_indices
+from utils.cache import chart_cache, dashboard_cache
+from utils.events import broker
 
 # Handle system
 
@@ -18,6 +26,18 @@ def get_system(db: Session, system_id:  int):
     return db.query(models.System).filter(models.System.id == system_id).first()
 
 
+def get_system_topology(db: Session, system_id: int):
+    # Devices, shifts, sections, their sensor controlers and timers in one query per relationship
+    shifts = selectinload(models.System.system_shifts)
+    return db.query(models.System).options(
+        selectinload(models.System.system_pumps),
+        selectinload(models.System.system_valves),
+        selectinload(models.System.system_sensors),
+        shifts.selectinload(models.Shift.shifts_sections).selectinload(models.Section.section_sensors),
+        shifts.selectinload(models.Shift.shift_timers),
+    ).filter(models.System.id == system_id).first()
+
+
 def get_systemID(db: Session, systemID: str):
     return db.query(models.System).filter(models.System.systemID == systemID).first()
 
@@ -37,6 +57,7 @@ def update_system(db: Session, system: devices.SystemUpdate, system_id: int):
         return False
     system_query.update(system.dict(), synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate(system_id)
     return True
 
 
@@ -47,6 +68,7 @@ def delete_system(system_id: int, db: Session):
         return False
     existing_system.delete(synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate(system_id)
     return True
 
 # Handle pumps
@@ -68,6 +90,7 @@ def create_pump(db: Session, pump: devices.AddPump):
     db_pump = models.Pump(**pump.dict())
     db.add(db_pump)
     db.commit()
+    dashboard_cache.invalidate(pump.system_id)
     db.refresh(db_pump)
     return db_pump
 
@@ -78,6 +101,7 @@ def update_pump(db: Session, pump: devices.UpdatePump, pump_id: str):
         return False
     pump_query.update(pump.dict(), synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("device", pump_id)
     return True
 
 
@@ -88,6 +112,7 @@ def delete_pump(pump_id: str, db: Session):
         return False
     existing_pump.delete(synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("device", pump_id)
     return True
 
 # Handle Valves
@@ -109,6 +134,7 @@ def create_valve(db: Session, valve: devices.AddValve):
     db_valve = models.Valve(**valve.dict())
     db.add(db_valve)
     db.commit()
+    dashboard_cache.invalidate(valve.system_id)
     db.refresh(db_valve)
     return db_valve
 
@@ -120,6 +146,8 @@ def update_valve(db: Session, valve: devices.UpdateValve, valve_id: str):
         return False
     valve_query.update(valve.dict(), synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("device", valve_id)
+    broker.publish(valve_id, {"type": "valve", "valve_id": valve_id, "status": valve.status})
     return True
 
 
@@ -130,6 +158,8 @@ def update_valve_status(db: Session, valve: devices.UpdateValveStatus, valve_id:
         return False
     valve_query.update(valve.dict(), synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("device", valve_id)
+    broker.publish(valve_id, {"type": "valve", "valve_id": valve_id, "status": valve.status})
     return True
 
 
@@ -140,6 +170,7 @@ def delete_valve(valve_id: str, db: Session):
         return False
     existing_valve.delete(synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("device", valve_id)
     print(f"Valve {valve_id} was deleted.")
     existing_section = db.query(models.Section).filter(
         models.Section.valve_id == valve_id)
@@ -167,6 +198,7 @@ def create_sensor(db: Session, sensor: devices.AddSensor):
     db_sensor = models.Sensor(**sensor.dict())
     db.add(db_sensor)
     db.commit()
+    dashboard_cache.invalidate(sensor.system_id)
     db.refresh(db_sensor)
     return db_sensor
 
@@ -178,6 +210,7 @@ def update_sensor(db: Session, sensor: devices.UpdateSensor, sensor_id: str):
         return False
     sensor_query.update(sensor.dict(), synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("device", sensor_id)
     return True
 
 
@@ -188,6 +221,7 @@ def delete_sensor(sensor_id: str, db: Session):
         return False
     existing_sensor.delete(synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("device", sensor_id)
     return True
 
 # Handle shifts
@@ -209,6 +243,7 @@ def create_shift(db: Session, shift: devices.AddShift):
     db_shift = models.Shift(**shift.dict())
     db.add(db_shift)
     db.commit()
+    dashboard_cache.invalidate(shift.system_id)
     db.refresh(db_shift)
     return db_shift
 
@@ -220,6 +255,7 @@ def delete_shift(shift_id: int, db: Session):
         return False
     existing_shift.delete(synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("shift", shift_id)
     print(f"Shift {shift_id} was deleted.")
     existing_timer_controler = db.query(models.Timer).filter(
         models.Timer.shift_id == shift_id)
@@ -236,6 +272,7 @@ def update_shift(db: Session, shift: devices.UpdateShift, shift_id: int):
         return False
     shift_query.update(shift.dict(), synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("shift", shift_id)
     print(f"Updating shift ID:{shift_id}....")
     return True
 
@@ -277,6 +314,7 @@ def create_section(db: Session, section: devices.SectionCreate):
     db_section = models.Section(**section.dict())
     db.add(db_section)
     db.commit()
+    dashboard_cache.invalidate_member("shift", section.shift_id)
     db.refresh(db_section)
     return db_section
 
@@ -288,6 +326,7 @@ def change_section(db: Session, section: devices.SectionUpdate, id: int):
         return False
     section_query.update(section.dict(), synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("section", id)
     return True
 
 
@@ -298,6 +337,7 @@ def delete_section(id: int, db: Session):
         return False
     existing_section.delete(synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("section", id)
     print(f"Deleting section ID:{id}...")
     existing_sesor_controler = db.query(models.SensorControler).filter(
         models.SensorControler.section_id == id)
@@ -322,6 +362,7 @@ def add_new_sensor_controler(db: Session, scontroler: devices.SensorControler):
     db_controler = models.SensorControler(**scontroler.dict())
     db.add(db_controler)
     db.commit()
+    dashboard_cache.invalidate_member("section", scontroler.section_id)
     db.refresh(db_controler)
     return db_controler
 
@@ -333,6 +374,7 @@ def change_sensor_controler(db: Session, scontroler: devices.SensorControler, id
         return False
     controler_query.update(scontroler.dict(), synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("controler", id)
     return True
 
 
@@ -343,6 +385,7 @@ def delete_sensor_controler(id: int, db: Session):
         return False
     existing_controler.delete(synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("controler", id)
     return True
 
 
@@ -363,6 +406,7 @@ def add_new_timer(db: Session, tcontroler: devices.TimerControl):
     db_controler = models.Timer(**tcontroler.dict())
     db.add(db_controler)
     db.commit()
+    dashboard_cache.invalidate_member("shift", tcontroler.shift_id)
     db.refresh(db_controler)
     return db_controler
 
@@ -404,6 +448,7 @@ def change_timer_settings(db: Session, tcontroler: devices.TimerUpdate, id: int)
         return False
     controler_query.update(tcontroler.dict(), synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("timer", id)
     return True
 
 
@@ -413,14 +458,29 @@ def delete_timer(id: int, db: Session):
         return False
     existing_timer.delete(synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("timer", id)
     return True
 
 
 # Handle logs
 
 
-def get_logs(db: Session, skip: int = 0, limit: int = 50):
-    return db.query(models.Logs).offset(skip).limit(limit).all()
+def get_logs(db: Session, cursor: Optional[tuple] = None, limit: int = 50):
+    return paginate(db.query(models.Logs), models.Logs.date, models.Logs.id,
+                    cursor=cursor, limit=limit, descending=True)
+
+
+def get_system_logs(db: Session, system_id: int, cursor: Optional[tuple] = None, limit: int = 50):
+    # Logs of every device in the system, each row tagged with dev_type pump, valve or sensor
+    system_devices = union_all(
+        select(models.Pump.pump_id.label("dev_id"), literal("pump").label("dev_type")).where(
+            models.Pump.system_id == system_id),
+        select(models.Valve.valve_id, literal("valve")).where(models.Valve.system_id == system_id),
+        select(models.Sensor.sensor_id, literal("sensor")).where(models.Sensor.system_id == system_id),
+    ).subquery()
+    query = db.query(*models.Logs.__table__.columns, system_devices.c.dev_type).join(
+        system_devices, system_devices.c.dev_id == models.Logs.dev_id)
+    return paginate(query, models.Logs.date, models.Logs.id, cursor=cursor, limit=limit, descending=True)
 
 
 def get_dev_logs(db: Session, dev_id: str):
@@ -435,43 +495,203 @@ def create_log(db: Session, log: devices.LogCreate):
     db_log = models.Logs(**log.dict())
     db.add(db_log)
     db.commit()
+    dashboard_cache.invalidate_member("device", log.dev_id)
     db.refresh(db_log)
     return db_log
 
 
+def create_logs_batch(db: Session, logs: List[devices.LogCreate]):
+    rows = [log.dict() for log in logs]
+    if not rows:
+        return 0
+    db.execute(insert(models.Logs).values(rows))
+    db.commit()
+    for dev_id in {row["dev_id"] for row in rows}:
+        dashboard_cache.invalidate_member("device", dev_id)
+    return len(rows)
+
+
 def update_log(db: Session, log: devices.UpdateLog, log_id: int):
     log_query = db.query(models.Logs).filter(models.Logs.id == log_id)
-    if not log_query.first():
+    existing_log = log_query.first()
+    if not existing_log:
         return False
+    dev_id = existing_log.dev_id
     log_query.update(log.dict(), synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("device", dev_id)
     return True
 
 
 def delete_log(log_id: int, db: Session):
-    existing_log = db.query(models.Logs).filter(models.Logs.id == log_id)
-    if not existing_log.first():
+    log_query = db.query(models.Logs).filter(models.Logs.id == log_id)
+    existing_log = log_query.first()
+    if not existing_log:
         return False
-    existing_log.delete(synchronize_session=False)
+    dev_id = existing_log.dev_id
+    log_query.delete(synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("device", dev_id)
     return True
 
+# Handle time ranges, pages and buckets
+
+AGGREGATES = {"avg": func.avg, "min": func.min, "max": func.max, "sum": func.sum, "count": func.count}
+BUCKET_UNITS = {"m": "minutes", "h": "hours", "d": "days"}
+ROLLUP_BUCKETS = {width: granularity for granularity, width in rollups.GRANULARITIES.items()}
+
+
+def parse_bucket(bucket: str):
+    return timedelta(**{BUCKET_UNITS[bucket[-1]]: int(bucket[:-1])})
+
+
+def align_range(bucket: timedelta, start: Optional[datetime], end: Optional[datetime]):
+    # Whole buckets only, so the first and last bucket never mix in data outside the range
+    def aware(moment: datetime):
+        return moment if moment.tzinfo else moment.astimezone()
+
+    def floor(moment: datetime):
+        return moment - (moment - rollups.BUCKET_ORIGIN) % bucket
+
+    if start:
+        start = aware(start)
+        aligned = floor(start)
+        start = aligned if aligned == start else aligned + bucket
+    if end:
+        end = floor(aware(end))
+    return start, end
+
+
+def filter_dates(query, column, start: Optional[datetime], end: Optional[datetime]):
+    if start:
+        query = query.filter(column >= start)
+    if end:
+        query = query.filter(column < end)
+    return query
+
+
+def paginate(query, date_column, id_column, cursor: Optional[tuple] = None, limit: int = 1000,
+             descending: bool = False):
+    # Keyset pagination on (date, id) stays flat with depth, unlike offset
+    if cursor:
+        key = tuple_(date_column, id_column)
+        query = query.filter(key < tuple_(*cursor) if descending else key > tuple_(*cursor))
+    if descending:
+        query = query.order_by(date_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(date_column, id_column)
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], encode_cursor(last.date, last.id)
+
+
+def rollup_granularity(db: Session, name: str, bucket: timedelta, end: Optional[datetime]):
+    # Rollups answer hour/day buckets for ranges that closed before their last run,
+    # every run records its time in updated_at whether or not new rows arrived
+    granularity = ROLLUP_BUCKETS.get(bucket)
+    if not granularity or not end:
+        return None
+    watermark = rollups.get_watermark(db=db, name=name)
+    if not watermark or end > watermark.updated_at:
+        return None
+    return granularity
+
+# Handle latest device samples
+
+FLOW_COLUMNS = [models.FlowData.id, models.FlowData.pump_id, models.FlowData.flow_rate, models.FlowData.date]
+SENSOR_COLUMNS = [models.SensorData.id, models.SensorData.sensor_id, models.SensorData.level_1,
+                  models.SensorData.level_2, models.SensorData.level_3, models.SensorData.temperature,
+                  models.SensorData.moisture, models.SensorData.bat_level, models.SensorData.date]
+
+
+def save_last_data(db: Session, model, rows: List[dict]):
+    # Keeps one row per device; older samples arriving late never overwrite newer ones
+    key = "sensor_id" if model is models.LastSensorData else "pump_id"
+    latest = {}
+    for row in rows:
+        current = latest.get(row[key])
+        if not current or (row["date"], row["data_id"]) >= (current["date"], current["data_id"]):
+            latest[row[key]] = row
+    if not latest:
+        return
+    stmt = pg_insert(model).values(list(latest.values()))
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[key],
+        set_={name: stmt.excluded[name] for name in rows[0] if name != key},
+        where=model.date <= stmt.excluded.date))
+
 # Handle flow data
 
 
 def get_flow_data(db: Session, pump_id: str):
-    return db.query(models.FlowData).order_by(models.FlowData.pump_id, models.FlowData.date.desc()).filter(
-        models.FlowData.pump_id == pump_id).first()
-
-
-def get_all_flow_data(db: Session, pump_id: str):
-    return db.query(models.FlowData).filter(models.FlowData.pump_id == pump_id)
+    last_data = db.query(models.LastFlowData).filter(
+        models.LastFlowData.pump_id == pump_id).first()
+    if last_data:
+        return last_data
+    # Equality on pump_id plus date DESC is served by ix_flow_data_pump_id_date
+    return db.query(models.FlowData).filter(models.FlowData.pump_id == pump_id).order_by(
+        models.FlowData.date.desc()).first()
+
+
+def get_all_flow_data(db: Session, pump_id: str, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    query = db.query(models.FlowData).filter(models.FlowData.pump_id == pump_id)
+    return filter_dates(query, models.FlowData.date, start, end)
+
+
+def get_flow_buckets(db: Session, pump_id: str, bucket: timedelta, agg: str = "avg",
+                     start: Optional[datetime] = None, end: Optional[datetime] = None):
+    start, end = align_range(bucket, start, end)
+    granularity = rollup_granularity(db=db, name="flow_data", bucket=bucket, end=end)
+    if granularity and agg in ("sum", "count", "avg"):
+        rollup = models.FlowRollup
+        columns = {"sum": rollup.flow_sum, "count": rollup.count,
+                   "avg": rollup.flow_sum / func.nullif(rollup.count, 0)}
+        query = db.query(rollup.bucket.label("date"), columns[agg].label("flow_rate"), rollup.count).filter(
+            rollup.pump_id == pump_id, rollup.granularity == granularity)
+        return filter_dates(query, rollup.bucket, start, end).order_by(rollup.bucket)
+    data = models.FlowData
+    date = func.date_bin(bucket, data.date, rollups.BUCKET_ORIGIN)
+    query = db.query(date.label("date"), AGGREGATES[agg](data.flow_rate).label("flow_rate"),
+                     func.count(data.flow_rate).label("count")).filter(data.pump_id == pump_id)
+    return filter_dates(query, data.date, start, end).group_by(date).order_by(date)
+
+
+def get_daily_consumption(db: Session, pump_ids: List[str], days: int):
+    # UTC days of the last `days` days and a series per pump, days without flow are 0.
+    # Days that closed before the last rollup run are read from the daily rollups.
+    day = timedelta(days=1)
+    now = datetime.now(timezone.utc)
+    today = now - (now - rollups.BUCKET_ORIGIN) % day
+    dates = [today - day * offset for offset in reversed(range(days))]
+    if not pump_ids or not dates:
+        return dates, {}
+    since = dates[0]
+    split = since
+    covered = rollups.covered_until(db=db, name="flow_data", granularity="day")
+    if covered:
+        split = min(max(since, covered), today)
+    totals = {}
+    if split > since:
+        for row in rollups.get_flow_rollups(db=db, pump_ids=pump_ids, granularity="day", start=since, end=split):
+            totals[(row.pump_id, row.date)] = row.flow_rate
+    data = models.FlowData
+    bucket = func.date_bin(day, data.date, rollups.BUCKET_ORIGIN)
+    for row in db.query(data.pump_id, bucket.label("date"), func.sum(data.flow_rate).label("flow_rate")).filter(
+            data.pump_id.in_(pump_ids), data.date >= split).group_by(data.pump_id, bucket):
+        totals[(row.pump_id, row.date)] = row.flow_rate
+    return dates, {pump_id: [totals.get((pump_id, date)) or 0 for date in dates] for pump_id in pump_ids}
 
 
 def create_flow_data(db: Session, flow: devices.AddFlowData):
     db_data = models.FlowData(**flow.dict())
     db.add(db_data)
+    db.flush()
+    save_last_data(db=db, model=models.LastFlowData, rows=[flow_row(db_data)])
     db.commit()
+    chart_cache.invalidate("flow", flow.pump_id)
+    dashboard_cache.invalidate_member("device", flow.pump_id)
     db.refresh(db_data)
     return db_data
 
@@ -483,24 +703,129 @@ def update_pump_data(db: Session, pump_id: str, current: float):
     query_pump.update({models.Pump.current: current},
                       synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("device", pump_id)
+    broker.publish(pump_id, {"type": "pump", "pump_id": pump_id, "current": current})
     return True
 
-# Handle sensor data
 
+def get_missing_pumps(db: Session, pump_ids: List[str]):
+    found = db.query(models.Pump.pump_id).filter(
+        models.Pump.pump_id.in_(set(pump_ids))).all()
+    return set(pump_ids) - {pump_id for pump_id, in found}
 
-def get_sensor_data(db: Session, sensor_id: str):
-    return db.query(models.SensorData).order_by(models.SensorData.sensor_id, models.SensorData.date.desc()).filter(
-        models.SensorData.sensor_id == sensor_id).first()
+
+def create_flow_data_batch(db: Session, flows: List[devices.AddFlowData]):
+    rows = [flow.dict() for flow in flows]
+    if not rows:
+        return 0
+    inserted = db.execute(insert(models.FlowData).values(rows).returning(*FLOW_COLUMNS))
+    save_last_data(db=db, model=models.LastFlowData, rows=[flow_row(row) for row in inserted])
+
+    consumed = {}
+    for row in rows:
+        consumed[row["pump_id"]] = consumed.get(row["pump_id"], 0) + row["flow_rate"]
+    volumes = consume_pump_volume(db=db, consumed=consumed)
+    db.commit()
+    for pump_id in consumed:
+        chart_cache.invalidate("flow", pump_id)
+        dashboard_cache.invalidate_member("device", pump_id)
+    for pump_id, current in volumes.items():
+        broker.publish(pump_id, {"type": "pump", "pump_id": pump_id, "current": current})
+    return len(rows)
+
+
+def consume_pump_volume(db: Session, consumed: dict):
+    # Pump volume is decremented in SQL so concurrent posts can't lose updates
+    if not consumed:
+        return {}
+    totals = values(column("pump_id", String), column("flow_rate", Float),
+                    name="totals").data(list(consumed.items()))
+    volumes = db.execute(update(models.Pump).where(models.Pump.pump_id == totals.c.pump_id).values(
+        current=models.Pump.current - totals.c.flow_rate).returning(models.Pump.pump_id, models.Pump.current))
+    return dict(volumes.all())
+
+
+def flow_row(data):
+    return {"pump_id": data.pump_id, "data_id": data.id, "flow_rate": data.flow_rate, "date": data.date}
+
+
+def refresh_last_flow_data(db: Session, pump_ids: List[str]):
+    if not pump_ids:
+        return
+    latest = select(models.FlowData.pump_id, models.FlowData.id, models.FlowData.flow_rate,
+                    models.FlowData.date).filter(models.FlowData.pump_id.in_(set(pump_ids))).distinct(
+        models.FlowData.pump_id).order_by(models.FlowData.pump_id, models.FlowData.date.desc())
+    stmt = pg_insert(models.LastFlowData).from_select(["pump_id", "data_id", "flow_rate", "date"], latest)
+    db.execute(stmt.on_conflict_do_update(index_elements=["pump_id"], set_={
+        name: stmt.excluded[name] for name in ["data_id", "flow_rate", "date"]}))
+
+# Handle sensor data
 
 
-def get_all_sensor_data(db: Session, sensor_id: str):
-    return db.query(models.SensorData).filter(models.SensorData.sensor_id == sensor_id)
+def get_sensor_data(db: Session, sensor_id: str):
+    last_data = db.query(models.LastSensorData).filter(
+        models.LastSensorData.sensor_id == sensor_id).first()
+    if last_data:
+        return last_data
+    # Equality on sensor_id plus date DESC is served by ix_sensor_data_sensor_id_date
+    return db.query(models.SensorData).filter(models.SensorData.sensor_id == sensor_id).order_by(
+        models.SensorData.date.desc()).first()
+
+
+def get_sensors_data(db: Session, sensor_ids: List[str]):
+    # Latest sample of every sensor in the set, keyed by sensor_id, in at most two queries
+    sensor_ids = set(sensor_ids)
+    if not sensor_ids:
+        return {}
+    latest = {data.sensor_id: data for data in db.query(models.LastSensorData).filter(
+        models.LastSensorData.sensor_id.in_(sensor_ids))}
+    missing = sensor_ids - latest.keys()
+    if missing:
+        # DISTINCT ON walks ix_sensor_data_sensor_id_date once per sensor
+        history = db.query(models.SensorData).filter(models.SensorData.sensor_id.in_(missing)).distinct(
+            models.SensorData.sensor_id).order_by(models.SensorData.sensor_id, models.SensorData.date.desc())
+        latest.update((data.sensor_id, data) for data in history)
+    return latest
+
+
+def get_all_sensor_data(db: Session, sensor_id: str, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    query = db.query(models.SensorData).filter(models.SensorData.sensor_id == sensor_id)
+    return filter_dates(query, models.SensorData.date, start, end)
+
+
+def get_sensor_buckets(db: Session, sensor_id: str, bucket: timedelta, agg: str = "avg",
+                       start: Optional[datetime] = None, end: Optional[datetime] = None):
+    levels = ["level_1", "level_2", "level_3"]
+    start, end = align_range(bucket, start, end)
+    granularity = rollup_granularity(db=db, name="sensor_data", bucket=bucket, end=end)
+    if granularity:
+        rollup = models.SensorRollup
+        if agg == "avg":
+            columns = [(getattr(rollup, f"{level}_sum") / func.nullif(getattr(rollup, f"{level}_count"), 0)).label(level)
+                       for level in levels]
+        elif agg == "count":
+            columns = [getattr(rollup, f"{level}_count").label(level) for level in levels]
+        else:
+            columns = [getattr(rollup, f"{level}_{agg}").label(level) for level in levels]
+        query = db.query(rollup.bucket.label("date"), *columns, rollup.count).filter(
+            rollup.sensor_id == sensor_id, rollup.granularity == granularity)
+        return filter_dates(query, rollup.bucket, start, end).order_by(rollup.bucket)
+    data = models.SensorData
+    date = func.date_bin(bucket, data.date, rollups.BUCKET_ORIGIN)
+    query = db.query(date.label("date"), *[AGGREGATES[agg](getattr(data, level)).label(level) for level in levels],
+                     func.count().label("count")).filter(data.sensor_id == sensor_id)
+    return filter_dates(query, data.date, start, end).group_by(date).order_by(date)
 
 
 def create_sensor_data(db: Session, sensor: devices.AddSensorData):
     db_data = models.SensorData(**sensor.dict())
     db.add(db_data)
+    db.flush()
+    save_last_data(db=db, model=models.LastSensorData, rows=[sensor_row(db_data)])
     db.commit()
+    chart_cache.invalidate("sensor", sensor.sensor_id)
+    dashboard_cache.invalidate_member("device", sensor.sensor_id)
+    broker.publish(sensor.sensor_id, sensor_event(sensor.dict()))
     db.refresh(db_data)
     return db_data
 
@@ -513,38 +838,155 @@ def update_sensor_data(db: Session, sensor_id: str, readings: float):
     query_readings.update(
         {models.Sensor.readings: readings}, synchronize_session=False)
     db.commit()
+    dashboard_cache.invalidate_member("device", sensor_id)
+    broker.publish(sensor_id, {"type": "sensor", "sensor_id": sensor_id, "readings": readings})
     return True
 
 
-""" Images and figures """
+def get_missing_sensors(db: Session, sensor_ids: List[str]):
+    found = db.query(models.Sensor.sensor_id).filter(
+        models.Sensor.sensor_id.in_(set(sensor_ids))).all()
+    return set(sensor_ids) - {sensor_id for sensor_id, in found}
+
 
+def create_sensor_data_batch(db: Session, sensors: List[devices.AddSensorData]):
+    rows = [sensor.dict() for sensor in sensors]
+    if not rows:
+        return 0
+    inserted = db.execute(insert(models.SensorData).values(rows).returning(*SENSOR_COLUMNS))
+    save_last_data(db=db, model=models.LastSensorData, rows=[sensor_row(row) for row in inserted])
 
-# def create_flow_image(pump_id: str, db: Session):
-#     pump_data = get_all_flow_data(db=db, pump_id=pump_id)
-#     flow_df = pd.read_sql(sql=pump_data.statement, con=engine)
-#     fig = px.bar(flow_df, x="date", y="flow_rate", title="Daily Consumption") 
-#     fig.write_image(f"static/images/flowimg/{pump_id}.png")
-
-
-def show_flow_fig(id: str, db: Session):
-    pump_data = get_all_flow_data(db=db, pump_id=id)
-    try:
-        flow_df = pd.read_sql(sql=pump_data.statement, con=engine)
-        fig = px.bar(flow_df, x="date", y="flow_rate", title="Daily Consumption")
-        return fig
-    except TypeError:
-        return 
-
-
-def show_sensor_fig(id: str, db: Session):
-    sensor_data = get_all_sensor_data(db=db, sensor_id=id)
-    try:
-        sensor_df = pd.read_sql(sql=sensor_data.statement, con=engine)
-        fig = px.line(sensor_df, x="date", y=["level_1", "level_2", "level_3"], labels={
-        "value": "Moisture (%)",
-        "date": "Measurement date",
-        "variable": "Measurement"
-        }, title="Sensor Readings")
-        return fig
-    except TypeError:
+    last_rows = {row["sensor_id"]: row for row in rows}
+    latest = values(column("sensor_id", String), column("level_1", Float),
+                    column("level_2", Float), column("level_3", Float),
+                    name="latest").data([(row["sensor_id"], row["level_1"], row["level_2"], row["level_3"])
+                                         for row in last_rows.values()])
+    readings = set_sensor_readings(db=db, latest=latest)
+    db.commit()
+    for sensor_id, row in last_rows.items():
+        chart_cache.invalidate("sensor", sensor_id)
+        dashboard_cache.invalidate_member("device", sensor_id)
+        broker.publish(sensor_id, sensor_event(row, readings=readings.get(sensor_id)))
+    return len(rows)
+
+
+def set_sensor_readings(db: Session, latest):
+    # Readings follow the last sample of every sensor, weighted by its level settings
+    flags = [models.Sensor.set_lvl_1, models.Sensor.set_lvl_2, models.Sensor.set_lvl_3]
+    levels = [latest.c.level_1, latest.c.level_2, latest.c.level_3]
+    total = sum(case((flag == True, level), else_=0) for flag, level in zip(flags, levels))
+    selected = sum(case((flag == True, 1), else_=0) for flag in flags)
+    readings = db.execute(update(models.Sensor).where(models.Sensor.sensor_id == latest.c.sensor_id).values(
+        readings=func.coalesce(total / func.nullif(selected, 0), 0)).returning(
+        models.Sensor.sensor_id, models.Sensor.readings))
+    return dict(readings.all())
+
+
+def refresh_sensor_readings(db: Session, sensor_ids: List[str]):
+    if not sensor_ids:
         return
+    latest = select(models.SensorData.sensor_id, models.SensorData.level_1,
+                    models.SensorData.level_2, models.SensorData.level_3).filter(
+        models.SensorData.sensor_id.in_(set(sensor_ids))).distinct(models.SensorData.sensor_id).order_by(
+        models.SensorData.sensor_id, models.SensorData.date.desc()).subquery()
+    set_sensor_readings(db=db, latest=latest)
+
+
+def sensor_row(data):
+    return {"sensor_id": data.sensor_id, "data_id": data.id, "level_1": data.level_1, "level_2": data.level_2,
+            "level_3": data.level_3, "temperature": data.temperature, "moisture": data.moisture,
+            "bat_level": data.bat_level, "date": data.date}
+
+
+def sensor_event(data, readings: Optional[float] = None):
+    event = {"type": "sensor", "sensor_id": data["sensor_id"]}
+    event.update({name: data[name] for name in ["level_1", "level_2", "level_3", "temperature", "moisture", "bat_level"]})
+    if readings is not None:
+        event["readings"] = readings
+    return event
+
+
+def refresh_last_sensor_data(db: Session, sensor_ids: List[str]):
+    if not sensor_ids:
+        return
+    latest = select(*SENSOR_COLUMNS).filter(models.SensorData.sensor_id.in_(set(sensor_ids))).distinct(
+        models.SensorData.sensor_id).order_by(models.SensorData.sensor_id, models.SensorData.date.desc())
+    names = ["data_id", "sensor_id", "level_1", "level_2", "level_3", "temperature", "moisture", "bat_level", "date"]
+    stmt = pg_insert(models.LastSensorData).from_select(names, latest)
+    db.execute(stmt.on_conflict_do_update(index_elements=["sensor_id"], set_={
+        name: stmt.excluded[name] for name in names if name != "sensor_id"}))
+
+
+""" Images and figures """
+
+
+def chart_granularity(db: Session, device_column, date_column, device_id: str):
+    # Short histories are plotted raw, longer ones from the hourly or daily rollups
+    first, last = db.query(func.min(date_column), func.max(date_column)).filter(device_column == device_id).one()
+    if not first or (last - first).days <= settings.chart_raw_days:
+        return None
+    if (last - first).days <= settings.chart_hourly_days:
+        return "hour"
+    return "day"
+
+
+def chart_series(rows, columns: List[str], points: int):
+    return downsample_series([row.date for row in rows], {name: [getattr(row, name) for row in rows] for name in columns},
+                             points)
+
+
+def downsample_series(dates, series: dict, points: int):
+    dates = np.array(dates, dtype=object)
+    series = {name: np.array(values, dtype=float) for name, values in series.items()}
+    picks = downsample_indices(dates, list(series.values()), points)
+    return {"x": [dates[i].isoformat() for i in picks],
+            "y": {name: [None if np.isnan(value) else value for value in values[picks].tolist()]
+                  for name, values in series.items()}}
+
+
+def flow_chart_data(db: Session, pump_id: str, points: int = 1000):
+    dates, series = get_daily_consumption(db=db, pump_ids=[pump_id], days=settings.chart_consumption_days)
+    return {"title": "Daily Consumption", "type": "bar",
+            **downsample_series(dates, {"flow_rate": series[pump_id]}, points)}
+
+
+def sensor_chart_data(db: Session, sensor_id: str, points: int = 1000):
+    levels = ["level_1", "level_2", "level_3"]
+    data = models.SensorData
+    granularity = chart_granularity(db=db, device_column=data.sensor_id, date_column=data.date, device_id=sensor_id)
+    if not granularity:
+        query = db.query(data.date, *[getattr(data, level) for level in levels]).filter(
+            data.sensor_id == sensor_id).order_by(data.date)
+        return {"title": "Sensor Readings", "type": "line", **chart_series(query.all(), levels, points)}
+    # Buckets before the last rollup run come from the rollups, the rest is binned from raw rows
+    rows = []
+    covered = rollups.covered_until(db=db, name="sensor_data", granularity=granularity)
+    if covered:
+        rows += rollups.get_sensor_rollups(db=db, sensor_id=sensor_id, granularity=granularity, end=covered).all()
+    bucket = rollups.bucket_start(data.date, granularity)
+    query = db.query(bucket.label("date"), *[func.avg(getattr(data, level)).label(level) for level in levels]).filter(
+        data.sensor_id == sensor_id)
+    query = filter_dates(query, data.date, covered, None)
+    rows += query.group_by(bucket).order_by(bucket).all()
+    return {"title": "Sensor Readings", "type": "line", **chart_series(rows, levels, points)}
+
+
+CHARTS = {"flow": (get_flow_data, flow_chart_data), "sensor": (get_sensor_data, sensor_chart_data)}
+
+
+def sample_marker(sample):
+    # Latest sample id and date, so cached charts of other workers go stale on new data too
+    if not sample:
+        return None
+    return getattr(sample, "data_id", None) or sample.id, sample.date.isoformat()
+
+
+def chart_json(db: Session, kind: str, device_id: str, points: int):
+    """ Serialized chart series of a device, kept in chart_cache until the device reports new data """
+    latest, build = CHARTS[kind]
+    key = (kind, device_id, sample_marker(latest(db, device_id)), points)
+    payload = chart_cache.get(key)
+    if payload is None:
+        payload = json.dumps(build(db, device_id, points=points))
+        chart_cache.set(key, payload)
+    return payload
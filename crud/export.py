@@ -0,0 +1,128 @@
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import select
+
+from db import models
+from db.database import SessionLocal
+from crud.devices import filter_dates
+
+
+EXPORT_CHUNK_ROWS = 2000
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+SENSOR_EXPORT_COLUMNS = [models.SensorData.id, models.SensorData.sensor_id, models.SensorData.date,
+                         models.SensorData.level_1, models.SensorData.level_2, models.SensorData.level_3,
+                         models.SensorData.temperature, models.SensorData.moisture, models.SensorData.bat_level]
+FLOW_EXPORT_COLUMNS = [models.FlowData.id, models.FlowData.pump_id, models.FlowData.date, models.FlowData.flow_rate]
+
+
+def sensor_export(sensor_id: str, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    statement = select(*SENSOR_EXPORT_COLUMNS).where(models.SensorData.sensor_id == sensor_id)
+    return filter_dates(statement, models.SensorData.date, start, end).order_by(
+        models.SensorData.date, models.SensorData.id)
+
+
+def flow_export(pump_id: str, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    statement = select(*FLOW_EXPORT_COLUMNS).where(models.FlowData.pump_id == pump_id)
+    return filter_dates(statement, models.FlowData.date, start, end).order_by(
+        models.FlowData.date, models.FlowData.id)
+
+
+def system_sensor_export(system_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    statement = select(*SENSOR_EXPORT_COLUMNS).join(
+        models.Sensor, models.Sensor.sensor_id == models.SensorData.sensor_id).where(
+        models.Sensor.system_id == system_id)
+    return filter_dates(statement, models.SensorData.date, start, end).order_by(
+        models.SensorData.date, models.SensorData.id)
+
+
+def system_flow_export(system_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    statement = select(*FLOW_EXPORT_COLUMNS).join(
+        models.Pump, models.Pump.pump_id == models.FlowData.pump_id).where(
+        models.Pump.system_id == system_id)
+    return filter_dates(statement, models.FlowData.date, start, end).order_by(
+        models.FlowData.date, models.FlowData.id)
+
+
+SYSTEM_EXPORTS = {"sensordata": system_sensor_export, "flowdata": system_flow_export}
+
+
+def stream_partitions(statement, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    # Own session: the request session may be closed before the response body is sent
+    db = SessionLocal()
+    try:
+        result = db.execute(statement.execution_options(stream_results=True, yield_per=chunk_rows))
+        yield list(result.keys())
+        for partition in result.partitions():
+            yield partition
+    finally:
+        db.close()
+
+
+def encode_ndjson(partitions):
+    columns = next(partitions)
+    for partition in partitions:
+        lines = []
+        for row in partition:
+            record = dict(zip(columns, row))
+            record["date"] = record["date"].timestamp()
+            lines.append(json.dumps(record))
+        yield "\n".join(lines) + "\n"
+
+
+def encode_csv(partitions):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(next(partitions))
+    for partition in partitions:
+        writer.writerows([value.isoformat() if isinstance(value, datetime) else value for value in row]
+                         for row in partition)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+ENCODERS = {"ndjson": encode_ndjson, "csv": encode_csv}
+
+
+def export_stream(statement, file_format: str):
+    return ENCODERS[file_format](stream_partitions(statement))
+
+
+""" Columnar exports, pyarrow is only needed when they are used """
+COLUMNAR_FORMATS = {"parquet": "application/vnd.apache.parquet", "arrow": "application/vnd.apache.arrow.file"}
+
+
+def arrow_schema(pa, columns):
+    types = {"id": pa.int64(), "sensor_id": pa.string(), "pump_id": pa.string(),
+             "date": pa.timestamp("us", tz="UTC")}
+    return pa.schema([(name, types.get(name, pa.float64())) for name in columns])
+
+
+def write_columnar(statement, sink, file_format: str, chunk_rows: int = EXPORT_CHUNK_ROWS * 10):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    partitions = stream_partitions(statement, chunk_rows=chunk_rows)
+    columns = next(partitions)
+    schema = arrow_schema(pa, columns)
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_file(sink, schema)
+    rows = 0
+    try:
+        for partition in partitions:
+            # Each cursor partition becomes one record batch, built column by column
+            arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*partition), schema)]
+            writer.write_table(pa.Table.from_batches([pa.record_batch(arrays, schema=schema)]))
+            rows += len(partition)
+    finally:
+        writer.close()
+    return rows
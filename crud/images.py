@@ -0,0 +1,179 @@
+""" Static PNG/SVG charts for emailed reports and kiosk displays
+
+    python -m crud.images
+"""
+import asyncio
+import fcntl
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from sqlalchemy.orm import Session
+
+from crud import devices
+from db import models
+from db.database import SessionLocal
+from utils.config import settings
+
+
+IMAGE_DIR = os.path.join("static", "images", "flowimg")
+LOCK_PATH = os.path.join(IMAGE_DIR, ".render.lock")
+IMAGE_FORMATS = ["png", "svg"]
+IMAGE_POINTS = 1000
+
+CHARTS = {
+    "flow": (models.LastFlowData, models.LastFlowData.pump_id,
+             lambda db, device_id, points: devices.flow_chart_data(db=db, pump_id=device_id, points=points)),
+    "sensor": (models.LastSensorData, models.LastSensorData.sensor_id,
+               lambda db, device_id, points: devices.sensor_chart_data(db=db, sensor_id=device_id, points=points)),
+}
+
+
+def image_prefix(kind: str, device_id: str):
+    # Hex of the id keeps every device apart, "a.b" and "a_b" included
+    return f"{kind}_{device_id.encode().hex()}"
+
+
+def image_path(kind: str, device_id: str, chart: dict, image_format: str):
+    # Same data gives the same file name, so unchanged charts are never rendered twice
+    content = json.dumps([chart, image_format, settings.chart_image_width, settings.chart_image_height],
+                         sort_keys=True)
+    digest = hashlib.sha1(content.encode()).hexdigest()[:16]
+    return os.path.join(IMAGE_DIR, f"{image_prefix(kind, device_id)}_{digest}.{image_format}")
+
+
+def device_images(kind: str, device_id: str, image_format: str):
+    pattern = re.compile(rf"^{image_prefix(kind, device_id)}_[0-9a-f]{{16}}\.{image_format}$")
+    try:
+        names = os.listdir(IMAGE_DIR)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(IMAGE_DIR, name) for name in names if pattern.match(name)]
+
+
+def current_image(kind: str, device_id: str, image_format: str):
+    paths = device_images(kind=kind, device_id=device_id, image_format=image_format)
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+def remove_old_images(kind: str, device_id: str, image_format: str, keep: str):
+    for path in device_images(kind=kind, device_id=device_id, image_format=image_format):
+        if path != keep:
+            os.remove(path)
+
+
+def render_chart(chart: dict, path: str, image_format: str, width: int, height: int):
+    # Runs in a worker process, plotly and kaleido are never loaded by the web workers
+    import plotly.graph_objects as go
+
+    trace = go.Bar if chart["type"] == "bar" else go.Scatter
+    fig = go.Figure([trace(x=chart["x"], y=values, name=name) for name, values in chart["y"].items()])
+    fig.update_layout(title=chart["title"], showlegend=len(chart["y"]) > 1)
+    temporary = f"{path}.tmp"
+    fig.write_image(temporary, format=image_format, width=width, height=height)
+    os.replace(temporary, path)
+    return path
+
+
+class ChartRenderer:
+    """ Re-renders device charts in a process pool whenever a device reports new data """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._pool = None
+        self._rendered = {}
+
+    def start(self):
+        if self._pool is None:
+            os.makedirs(IMAGE_DIR, exist_ok=True)
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context("spawn"))
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stale_devices(self, db: Session):
+        # The latest sample id of every device tells whether its chart is out of date
+        for kind, (model, device_column, _) in CHARTS.items():
+            for device_id, data_id in db.query(device_column, model.data_id):
+                if self._rendered.get((kind, device_id)) != data_id:
+                    yield kind, device_id, data_id
+
+    def submit(self, db: Session, kind: str, device_id: str):
+        chart = CHARTS[kind][2](db=db, device_id=device_id, points=IMAGE_POINTS)
+        jobs = {}
+        for image_format in IMAGE_FORMATS:
+            path = image_path(kind=kind, device_id=device_id, chart=chart, image_format=image_format)
+            if os.path.exists(path):
+                remove_old_images(kind=kind, device_id=device_id, image_format=image_format, keep=path)
+                continue
+            future = self._pool.submit(render_chart, chart, path, image_format,
+                                       settings.chart_image_width, settings.chart_image_height)
+            jobs[future] = image_format
+        return jobs
+
+    def render_stale(self):
+        os.makedirs(IMAGE_DIR, exist_ok=True)
+        with open(LOCK_PATH, "w") as lock:
+            # Every web worker runs a renderer, only the one holding the lock touches the files
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            return self._render_stale()
+
+    def _render_stale(self):
+        self.start()
+        db = SessionLocal()
+        jobs = {}
+        try:
+            for kind, device_id, data_id in list(self.stale_devices(db=db)):
+                for future, image_format in self.submit(db=db, kind=kind, device_id=device_id).items():
+                    jobs[future] = (kind, device_id, image_format)
+                self._rendered[(kind, device_id)] = data_id
+        except BrokenProcessPool as error:
+            # A worker died, jobs already submitted fail below and the pool is rebuilt on the next run
+            print(f"Chart render pool is broken: {error}")
+            self.stop()
+        finally:
+            db.close()
+        wait(jobs)
+        rendered = 0
+        for future, (kind, device_id, image_format) in jobs.items():
+            try:
+                path = future.result()
+            except Exception as error:
+                # Try again on the next run
+                self._rendered.pop((kind, device_id), None)
+                if isinstance(error, BrokenProcessPool):
+                    self.stop()
+                print(f"Rendering {kind} chart of {device_id} failed: {error}")
+                continue
+            remove_old_images(kind=kind, device_id=device_id, image_format=image_format, keep=path)
+            rendered += 1
+        return rendered
+
+    async def run(self, interval: float):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.render_stale)
+            except Exception as error:
+                print(f"Chart rendering failed: {error}")
+            await asyncio.sleep(interval)
+
+
+chart_renderer = ChartRenderer(workers=settings.chart_render_workers)
+
+
+if __name__ == "__main__":
+    try:
+        print(f"Rendered {chart_renderer.render_stale()} chart images into {IMAGE_DIR}")
+    finally:
+        chart_renderer.stop()
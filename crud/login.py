@@ -1,11 +1,41 @@
+import time
+from functools import cached_property
+
 from sqlalchemy.orm import Session
 from fastapi import Depends, HTTPException, status
+from jose import jwt
 
 from crud import users
+from db import models
 from db.database import get_db
 from schema.users import Login
 from utils.auth import security, verify_token, verify_password
+from utils.cache import user_cache
+
+
+class CurrentUser:
+    """ Request view of a cached user snapshot, relationships are read through the request session """
+
+    def __init__(self, snapshot: users.UserSnapshot, db: Session):
+        self._snapshot = snapshot
+        self._db = db
+
+    def __getattr__(self, name):
+        return getattr(self._snapshot, name)
 
+    @cached_property
+    def systems(self):
+        return self._db.query(models.System).filter(models.System.owner == self.username).all()
+
+    @cached_property
+    def alerts(self):
+        return users.user_alerts(db=self._db, user=self.username)
+
+
+def token_ttl(token: str):
+    # A cached token must not outlive its exp claim
+    expires = jwt.get_unverified_claims(token).get("exp")
+    return expires - time.time() if expires else None
 
 
 def get_current_user(db: Session = Depends(get_db), token: str=Depends(security)):
@@ -14,13 +44,17 @@ def get_current_user(db: Session = Depends(get_db), token: str=Depends(security)
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    
-    token_data = verify_token(token, credentials_exception)  
-    current_user = users.get_user(db, username=token_data.username)
-    if current_user is None:
-        raise credentials_exception
-    
-    return current_user
+
+    snapshot = user_cache.get(token)
+    if snapshot is None:
+        token_data = verify_token(token, credentials_exception)
+        current_user = users.get_user(db, username=token_data.username)
+        if current_user is None:
+            raise credentials_exception
+        snapshot = users.user_snapshot(current_user)
+        user_cache.set(token, snapshot, group=snapshot.username, ttl=token_ttl(token))
+
+    return CurrentUser(snapshot, db)
 
 
 def validate_user(db: Session, user: Login):
@@ -0,0 +1,164 @@
+""" Incremental hourly and daily rollups of sensor and flow history
+
+    python -m crud.rollups [--rebuild]
+"""
+import asyncio
+import sys
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+from sqlalchemy import and_, func, literal, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from db import models
+from db.database import SessionLocal, engine
+from utils.config import settings
+
+
+# Buckets are binned from a UTC origin, the same as the bucketed history endpoints on raw rows
+GRANULARITIES = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+BUCKET_ORIGIN = datetime(2000, 1, 1, tzinfo=timezone.utc)
+LEVELS = ["level_1", "level_2", "level_3"]
+
+
+def get_watermark(db: Session, name: str):
+    return db.query(models.RollupWatermark).filter(models.RollupWatermark.name == name).first()
+
+
+def set_watermark(db: Session, name: str, last_id: int, pending_id: int, pending_at: datetime):
+    stmt = pg_insert(models.RollupWatermark).values(name=name, last_id=last_id, pending_id=pending_id,
+                                                    pending_at=pending_at, updated_at=func.now())
+    db.execute(stmt.on_conflict_do_update(index_elements=["name"], set_={
+        column: stmt.excluded[column] for column in ["last_id", "pending_id", "pending_at", "updated_at"]}))
+
+
+def bucket_start(date_column, granularity: str):
+    return func.date_bin(GRANULARITIES[granularity], date_column, BUCKET_ORIGIN)
+
+
+def covered_until(db: Session, name: str, granularity: str):
+    """ Start of the bucket the last run fell in, rollups hold every bucket before it """
+    watermark = get_watermark(db=db, name=name)
+    if not watermark:
+        return None
+    return watermark.updated_at - (watermark.updated_at - BUCKET_ORIGIN) % GRANULARITIES[granularity]
+
+
+def touched_buckets(data, device_column, granularity: str, low: int):
+    # Every bucket holding a row past the watermark is aggregated again from all of its rows
+    bucket = bucket_start(data.date, granularity)
+    return select(device_column.label("device_id"), bucket.label("bucket")).where(
+        data.id > low).distinct().subquery()
+
+
+def bucket_rows(data, device_column, granularity: str, low: int):
+    touched = touched_buckets(data, device_column, granularity, low)
+    bucket = bucket_start(data.date, granularity)
+    return touched, bucket, and_(device_column == touched.c.device_id, data.date >= touched.c.bucket,
+                                 data.date < touched.c.bucket + GRANULARITIES[granularity])
+
+
+def rollup_sensor_data(db: Session, granularity: str, low: int):
+    data = models.SensorData
+    touched, bucket, joined = bucket_rows(data, data.sensor_id, granularity, low)
+    aggregates = []
+    names = ["sensor_id", "granularity", "bucket"]
+    for level in LEVELS:
+        column = getattr(data, level)
+        aggregates += [func.min(column), func.max(column), func.sum(column), func.count(column)]
+        names += [f"{level}_min", f"{level}_max", f"{level}_sum", f"{level}_count"]
+    names.append("count")
+    rows = select(data.sensor_id, literal(granularity), bucket, *aggregates, func.count()).select_from(
+        data).join(touched, joined).group_by(data.sensor_id, bucket)
+
+    # Buckets are rebuilt whole, so running over the same rows twice is harmless
+    stmt = pg_insert(models.SensorRollup).from_select(names, rows)
+    db.execute(stmt.on_conflict_do_update(index_elements=["sensor_id", "granularity", "bucket"], set_={
+        name: stmt.excluded[name] for name in names[3:]}))
+
+
+def rollup_flow_data(db: Session, granularity: str, low: int):
+    data = models.FlowData
+    touched, bucket, joined = bucket_rows(data, data.pump_id, granularity, low)
+    rows = select(data.pump_id, literal(granularity), bucket, func.sum(data.flow_rate),
+                  func.count(data.flow_rate)).select_from(data).join(touched, joined).group_by(data.pump_id, bucket)
+    stmt = pg_insert(models.FlowRollup).from_select(
+        ["pump_id", "granularity", "bucket", "flow_sum", "count"], rows)
+    db.execute(stmt.on_conflict_do_update(index_elements=["pump_id", "granularity", "bucket"], set_={
+        "flow_sum": stmt.excluded.flow_sum, "count": stmt.excluded["count"]}))
+
+
+ROLLUPS = {"sensor_data": (models.SensorData, rollup_sensor_data),
+           "flow_data": (models.FlowData, rollup_flow_data)}
+
+
+def run_rollups(db: Session):
+    # Ids are handed out before commit, so a row below max(id) can still become visible later.
+    # Every run re-aggregates the buckets touched past last_id, and last_id only moves up to the
+    # max(id) seen at least rollup_lag seconds ago, when the writers that held lower ids are done.
+    watermarks = {}
+    for name, (model, rollup) in ROLLUPS.items():
+        now = db.query(func.now()).scalar()
+        watermark = get_watermark(db=db, name=name)
+        low = watermark.last_id if watermark else 0
+        pending_id, pending_at = (watermark.pending_id, watermark.pending_at) if watermark else (None, None)
+        high = db.query(func.max(model.id)).scalar() or 0
+        if high > low:
+            for granularity in GRANULARITIES:
+                rollup(db=db, granularity=granularity, low=low)
+        if pending_at is None or pending_at <= now - timedelta(seconds=settings.rollup_lag):
+            low = max(low, pending_id or 0)
+            pending_id, pending_at = high, now
+        set_watermark(db=db, name=name, last_id=low, pending_id=pending_id, pending_at=pending_at)
+        db.commit()
+        watermarks[name] = low
+    return watermarks
+
+
+def rebuild_rollups():
+    # Rollups are derived data, dropping them makes the next run aggregate the whole history
+    tables = [models.SensorRollup.__table__, models.FlowRollup.__table__, models.RollupWatermark.__table__]
+    for table in tables:
+        table.drop(bind=engine, checkfirst=True)
+    for table in tables:
+        table.create(bind=engine)
+
+
+def run_rollups_once():
+    db = SessionLocal()
+    try:
+        return run_rollups(db=db)
+    finally:
+        db.close()
+
+
+async def run_rollup_pipeline(interval: float):
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, run_rollups_once)
+        except Exception as error:
+            print(f"Rollup run failed: {error}")
+        await asyncio.sleep(interval)
+
+
+def get_sensor_rollups(db: Session, sensor_id: str, granularity: str, end: datetime):
+    rollup = models.SensorRollup
+    return db.query(rollup.bucket.label("date"),
+                    *[(getattr(rollup, f"{level}_sum") / func.nullif(getattr(rollup, f"{level}_count"), 0)).label(level)
+                      for level in LEVELS]).filter(
+        rollup.sensor_id == sensor_id, rollup.granularity == granularity, rollup.bucket < end).order_by(rollup.bucket)
+
+
+def get_flow_rollups(db: Session, pump_ids: List[str], granularity: str, start: datetime, end: datetime):
+    rollup = models.FlowRollup
+    return db.query(rollup.pump_id, rollup.bucket.label("date"), rollup.flow_sum.label("flow_rate")).filter(
+        rollup.pump_id.in_(pump_ids), rollup.granularity == granularity, rollup.bucket >= start,
+        rollup.bucket < end).order_by(rollup.bucket)
+
+
+if __name__ == "__main__":
+    if "--rebuild" in sys.argv:
+        rebuild_rollups()
+    print(f"{datetime.now():%Y-%m-%d %H:%M:%S} rollups are at {run_rollups_once()}")
@@ -1,8 +1,11 @@
+from collections import namedtuple
+
 from sqlalchemy.orm import Session
 
 from db import models
 from schema.users import UserCreate, SubscriberCreate, NoteCreate, UserUpdate, AdminUserUpdate, UpdateNote, LostPassword, ResetPassword
 from utils.auth import get_hashed_password, generate_secret
+from utils.cache import user_cache, user_list_cache
 
 # Handling users
 def get_user(db: Session, username: str):
@@ -20,6 +23,20 @@ def get_user_by_secret(db: Session, secret: str):
 def get_users(db: Session, skip: int = 0, limit: int = 50):
     return db.query(models.User).offset(skip).limit(limit).all()
 
+# Immutable copy of the user columns, ORM instances can't be shared between request sessions
+UserSnapshot = namedtuple("UserSnapshot", ["username", "email", "name", "surname", "address", "admin", "premium",
+                                           "created_at", "updated_at", "delisted"])
+
+def user_snapshot(user: models.User):
+    return UserSnapshot(*[getattr(user, field) for field in UserSnapshot._fields])
+
+def get_sidebar_users(db: Session):
+    return user_list_cache.get(lambda: [user_snapshot(user) for user in get_users(db=db)])
+
+def invalidate_user(username: str):
+    user_cache.invalidate(username)
+    user_list_cache.bump()
+
 def create_user(db: Session, user: UserCreate):
     db_user = models.User(email=user.email, username = user.username, hashed_password=get_hashed_password(user.password), 
         name=user.name, surname=user.surname, address=user.address, admin=user.admin, premium=user.premium, delisted=user.delisted, 
@@ -29,6 +46,7 @@ def create_user(db: Session, user: UserCreate):
         db_user.admin = True
     db.add(db_user)
     db.commit()
+    user_list_cache.bump()
     db.refresh(db_user)
     return db_user
 
@@ -39,12 +57,15 @@ def change_password(db: Session, username: str, password: LostPassword):
     hashed_pwd = get_hashed_password(password.password)
     pwd_query.update({models.User.hashed_password: hashed_pwd}, synchronize_session=False)
     db.commit()
+    invalidate_user(username)
     return True
 
 def reset_password(db: Session, password: ResetPassword):
     reset_query = db.query(models.User).filter(models.User.secret == password.secret)
-    if not reset_query.first():
+    db_user = reset_query.first()
+    if not db_user:
         return False
+    username = db_user.username
     hashed_pwd = get_hashed_password(password.password)
     reset_query.update(
         {
@@ -53,6 +74,7 @@ def reset_password(db: Session, password: ResetPassword):
         }, 
         synchronize_session=False)
     db.commit()
+    invalidate_user(username)
     return True
 
 def update_user(db: Session, username: str, user: UserUpdate):
@@ -61,6 +83,7 @@ def update_user(db: Session, username: str, user: UserUpdate):
         return False
     user_query.update(user.dict(), synchronize_session=False)
     db.commit()
+    invalidate_user(username)
     return True
 
 def admin_update_user(db: Session, username: str, user: AdminUserUpdate):
@@ -69,6 +92,7 @@ def admin_update_user(db: Session, username: str, user: AdminUserUpdate):
         return False
     user_query.update(user.dict(), synchronize_session=False)
     db.commit()
+    invalidate_user(username)
     return True
 
 def delete_user(username: str , db: Session):
@@ -77,6 +101,7 @@ def delete_user(username: str , db: Session):
         return False
     existing_user.delete(synchronize_session=False)
     db.commit()
+    invalidate_user(username)
     return True
 
 # Handle new subscribers
@@ -108,6 +133,12 @@ def delete_subscriber(subscriber_id: int, db: Session):
 def alerts(db: Session):
     return db.query(models.Notification).all()
 
+def unread_alerts(db: Session, user: str, limit: int):
+    # Served by ix_notifications_user_read
+    return db.query(models.Notification).filter(
+        models.Notification.user == user, models.Notification.read.isnot(True)).order_by(
+        models.Notification.id.desc()).limit(limit).all()
+
 def user_alerts(db: Session, user: str):
     alerts = db.query(models.Notification).filter(models.Notification.user == user).all()
     return alerts
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, Integer, String, Text, Time, ForeignKey, Float
+from sqlalchemy import Boolean, Column, Integer, String, Text, Time, ForeignKey, Float, Index
 from sqlalchemy.sql.sqltypes import TIMESTAMP
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.expression import text
@@ -174,18 +174,25 @@ class Timer(Base):
 class FlowData(Base):
     __tablename__ = "flow_data"
 
-    id = Column(Integer, primary_key=True)
+    # Range partitioned by month on date, the partition key has to be part of the primary key
+    id = Column(Integer, primary_key=True, autoincrement=True)
     pump_id = Column(String(25), ForeignKey(
         "pumps.pump_id", ondelete="CASCADE"), nullable=False)
     flow_rate = Column(Float)
-    date = Column(TIMESTAMP(timezone=True), nullable=False,
+    date = Column(TIMESTAMP(timezone=True), primary_key=True, nullable=False,
                   server_default=text('now()'))
 
+    __table_args__ = (
+        Index("ix_flow_data_pump_id_date", pump_id, date.desc()),
+        {"postgresql_partition_by": "RANGE (date)"},
+    )
+
 
 class SensorData(Base):
     __tablename__ = "sensor_data"
 
-    id = Column(Integer, primary_key=True)
+    # Range partitioned by month on date, the partition key has to be part of the primary key
+    id = Column(Integer, primary_key=True, autoincrement=True)
     sensor_id = Column(String(25), ForeignKey(
         "sensors.sensor_id", ondelete="CASCADE"), nullable=False)
     level_1 = Column(Float)
@@ -194,9 +201,84 @@ class SensorData(Base):
     temperature = Column(Float)
     moisture = Column(Float)
     bat_level = Column(Float)
-    date = Column(TIMESTAMP(timezone=True), nullable=False,
+    date = Column(TIMESTAMP(timezone=True), primary_key=True, nullable=False,
                   server_default=text('now()'))
 
+    __table_args__ = (
+        Index("ix_sensor_data_sensor_id_date", sensor_id, date.desc()),
+        {"postgresql_partition_by": "RANGE (date)"},
+    )
+
+
+class LastFlowData(Base):
+    __tablename__ = "last_flow_data"
+
+    pump_id = Column(String(25), ForeignKey(
+        "pumps.pump_id", ondelete="CASCADE"), primary_key=True)
+    data_id = Column(Integer, nullable=False)
+    flow_rate = Column(Float)
+    date = Column(TIMESTAMP(timezone=True), nullable=False)
+
+
+class LastSensorData(Base):
+    __tablename__ = "last_sensor_data"
+
+    sensor_id = Column(String(25), ForeignKey(
+        "sensors.sensor_id", ondelete="CASCADE"), primary_key=True)
+    data_id = Column(Integer, nullable=False)
+    level_1 = Column(Float)
+    level_2 = Column(Float)
+    level_3 = Column(Float)
+    temperature = Column(Float)
+    moisture = Column(Float)
+    bat_level = Column(Float)
+    date = Column(TIMESTAMP(timezone=True), nullable=False)
+
+
+class SensorRollup(Base):
+    __tablename__ = "sensor_data_rollups"
+
+    sensor_id = Column(String(25), ForeignKey(
+        "sensors.sensor_id", ondelete="CASCADE"), primary_key=True)
+    granularity = Column(String(5), primary_key=True)
+    bucket = Column(TIMESTAMP(timezone=True), primary_key=True)
+    level_1_min = Column(Float)
+    level_1_max = Column(Float)
+    level_1_sum = Column(Float)
+    level_1_count = Column(Integer, nullable=False)
+    level_2_min = Column(Float)
+    level_2_max = Column(Float)
+    level_2_sum = Column(Float)
+    level_2_count = Column(Integer, nullable=False)
+    level_3_min = Column(Float)
+    level_3_max = Column(Float)
+    level_3_sum = Column(Float)
+    level_3_count = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False)
+
+
+class FlowRollup(Base):
+    __tablename__ = "flow_data_rollups"
+
+    pump_id = Column(String(25), ForeignKey(
+        "pumps.pump_id", ondelete="CASCADE"), primary_key=True)
+    granularity = Column(String(5), primary_key=True)
+    bucket = Column(TIMESTAMP(timezone=True), primary_key=True)
+    flow_sum = Column(Float)
+    count = Column(Integer, nullable=False)
+
+
+class RollupWatermark(Base):
+    __tablename__ = "rollup_watermarks"
+
+    # Ids below last_id are aggregated, pending_id becomes last_id once it is older than the rollup lag
+    name = Column(String(25), primary_key=True)
+    last_id = Column(Integer, nullable=False)
+    pending_id = Column(Integer)
+    pending_at = Column(TIMESTAMP(timezone=True))
+    updated_at = Column(TIMESTAMP(timezone=True),
+                        nullable=False, server_default=text('now()'))
+
 
 class Logs(Base):
     __tablename__ = "logs"
@@ -208,6 +290,12 @@ class Logs(Base):
     date = Column(TIMESTAMP(timezone=True), nullable=False,
                   server_default=text('now()'))
 
+    # dev_id lookups, and the (date, id) DESC keyset order of the log listings
+    __table_args__ = (
+        Index("ix_logs_dev_id_date", dev_id, date.desc()),
+        Index("ix_logs_date_id", date.desc(), id.desc()),
+    )
+
 
 class Notification(Base):
     __tablename__ = "notifications"
@@ -222,6 +310,8 @@ class Notification(Base):
 
     notes = relationship("User", back_populates="alerts")
 
+    __table_args__ = (Index("ix_notifications_user_read", user, read),)
+
 
 class Subscription(Base):
     __tablename__ = "subscriptions"
@@ -230,3 +320,10 @@ class Subscription(Base):
     mail = Column(String(50), unique=True)
     date = Column(TIMESTAMP(timezone=True), nullable=False,
                   server_default=text('now()'))
+
+
+def create_indexes(bind):
+    """ create_all only adds indexes for new tables, so existing deployments get them here """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
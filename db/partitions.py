@@ -0,0 +1,144 @@
+""" Monthly range partitions for sensor_data and flow_data
+
+    python -m db.partitions
+"""
+import asyncio
+import re
+from datetime import date
+
+from sqlalchemy import text
+
+from db.database import engine
+from utils.config import settings
+
+
+PARTITIONED_TABLES = ["sensor_data", "flow_data"]
+PARTITION_NAME = re.compile(r"_(\d{4})_(\d{2})$")
+
+
+def add_months(month: date, months: int):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def is_partitioned(connection, table: str):
+    relkind = connection.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"), {"table": table}).scalar()
+    return relkind == "p"
+
+
+def partitions(connection, table: str):
+    return connection.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = :table"), {"table": table}).scalars().all()
+
+
+def lock_table(connection, table: str):
+    # Web workers and the importer maintain partitions concurrently, one at a time per table
+    connection.execute(text("SELECT pg_advisory_xact_lock(hashtext(:table))"), {"table": f"partitions:{table}"})
+
+
+def create_partition(connection, table: str, month: date):
+    start, end = month, add_months(month, 1)
+    dates = {"start": start, "end": end}
+    bounds = f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    name = f"{table}_{start:%Y_%m}"
+    if name in partitions(connection, table):
+        return 0
+    stranded = connection.execute(text(
+        f"SELECT count(*) FROM {table}_default WHERE date >= :start AND date < :end"), dates).scalar()
+    if not stranded:
+        connection.execute(text(f"CREATE TABLE {name} PARTITION OF {table} {bounds}"))
+        return 0
+    # The month can't be created while the default partition holds its rows, move them over
+    connection.execute(text(f"ALTER TABLE {table} DETACH PARTITION {table}_default"))
+    connection.execute(text(f"CREATE TABLE {name} PARTITION OF {table} {bounds}"))
+    connection.execute(text(
+        f"INSERT INTO {table} SELECT * FROM {table}_default WHERE date >= :start AND date < :end"), dates)
+    connection.execute(text(f"DELETE FROM {table}_default WHERE date >= :start AND date < :end"), dates)
+    connection.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {table}_default DEFAULT"))
+    return stranded
+
+
+def create_partitions(connection, table: str, months_ahead: int, today: date = None):
+    # Rows outside every monthly range (clock skew, late samples) land in the default partition
+    connection.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+    this_month = (today or date.today()).replace(day=1)
+    for offset in range(months_ahead + 1):
+        create_partition(connection, table, add_months(this_month, offset))
+
+
+def drain_default(connection, table: str):
+    # Keeps the default partition empty, so retention applies to every row and creating a month scans nothing
+    months = connection.execute(text(
+        f"SELECT DISTINCT date_trunc('month', date)::date FROM {table}_default")).scalars().all()
+    return {month: create_partition(connection, table, month) for month in sorted(months)}
+
+
+def ensure_partitions(table: str, first: date, last: date):
+    """ Monthly partitions covering first..last, created before a backfill so it never lands in the default partition """
+    with engine.begin() as connection:
+        if not is_partitioned(connection, table):
+            return
+        lock_table(connection, table)
+        connection.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+        month = first.replace(day=1)
+        while month <= last:
+            create_partition(connection, table, month)
+            month = add_months(month, 1)
+
+
+def expire_partitions(connection, table: str, retention_months: int, drop: bool, today: date = None):
+    cutoff = add_months((today or date.today()).replace(day=1), -retention_months)
+    expired = []
+    for name in partitions(connection, table):
+        match = PARTITION_NAME.search(name)
+        if not match or date(int(match[1]), int(match[2]), 1) >= cutoff:
+            continue
+        connection.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+        if drop:
+            connection.execute(text(f"DROP TABLE {name}"))
+        expired.append(name)
+    return expired
+
+
+def prune_default(connection, table: str, retention_months: int, today: date = None):
+    cutoff = add_months((today or date.today()).replace(day=1), -retention_months)
+    return connection.execute(text(f"DELETE FROM {table}_default WHERE date < :cutoff"), {"cutoff": cutoff}).rowcount
+
+
+def maintain_partitions():
+    for table in PARTITIONED_TABLES:
+        with engine.begin() as connection:
+            if not is_partitioned(connection, table):
+                print(f"Table {table} is not partitioned, recreate it to enable monthly partitions.")
+                continue
+            lock_table(connection, table)
+            create_partitions(connection, table, settings.telemetry_partitions_ahead)
+            if settings.telemetry_retention_months > 0:
+                pruned = prune_default(connection, table, settings.telemetry_retention_months)
+                if pruned:
+                    print(f"Deleted {pruned} expired rows from {table}_default")
+            for month, moved in drain_default(connection, table).items():
+                print(f"Moved {moved} rows of {month:%Y-%m} out of {table}_default")
+            if settings.telemetry_retention_months > 0:
+                expired = expire_partitions(connection, table, settings.telemetry_retention_months,
+                                            settings.telemetry_drop_expired)
+                for name in expired:
+                    print(f"{'Dropped' if settings.telemetry_drop_expired else 'Detached'} partition {name}")
+
+
+async def run_partition_maintenance(interval: float = 24 * 60 * 60):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await loop.run_in_executor(None, maintain_partitions)
+        except Exception as error:
+            print(f"Partition maintenance failed: {error}")
+
+
+if __name__ == "__main__":
+    maintain_partitions()
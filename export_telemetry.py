@@ -0,0 +1,29 @@
+""" Columnar export of a system's sensor_data / flow_data for analytics
+
+    python export_telemetry.py 3 sensordata season.parquet --from 2024-03-01 --to 2024-10-01
+    python export_telemetry.py 3 flowdata season.arrow
+"""
+import argparse
+from datetime import datetime
+
+from crud import export
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a system's telemetry as Parquet or Arrow IPC")
+    parser.add_argument("system_id", type=int)
+    parser.add_argument("table", choices=sorted(export.SYSTEM_EXPORTS))
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=sorted(export.COLUMNAR_FORMATS), dest="file_format",
+                        help="Output format, detected from the file extension by default")
+    parser.add_argument("--from", type=datetime.fromisoformat, dest="start")
+    parser.add_argument("--to", type=datetime.fromisoformat, dest="end")
+    args = parser.parse_args()
+    file_format = args.file_format or ("arrow" if args.path.endswith((".arrow", ".feather")) else "parquet")
+    statement = export.SYSTEM_EXPORTS[args.table](system_id=args.system_id, start=args.start, end=args.end)
+    rows = export.write_columnar(statement, args.path, file_format)
+    print(f"Exported {rows} rows to {args.path}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+""" Bulk import of historical sensor_data / flow_data exports through COPY FROM STDIN
+
+    python import_telemetry.py sensor_data export.csv
+    python import_telemetry.py flow_data export.ndjson --chunk-size 50000
+"""
+import argparse
+import csv
+import io
+import json
+from itertools import chain
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.orm import Session
+
+from crud import devices
+from db.database import engine
+from db.partitions import ensure_partitions
+
+
+COLUMNS = {
+    "sensor_data": ["sensor_id", "level_1", "level_2", "level_3", "temperature", "moisture", "bat_level", "date"],
+    "flow_data": ["pump_id", "flow_rate", "date"],
+}
+DEVICE_COLUMN = {"sensor_data": "sensor_id", "flow_data": "pump_id"}
+
+
+def read_records(path: str, file_format: str):
+    with open(path, newline="", encoding="utf-8") as source:
+        if file_format == "csv":
+            yield from csv.DictReader(source)
+        else:
+            for line in source:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def parse_date(value):
+    # API exports serialize dates as unix timestamps
+    try:
+        return datetime.fromtimestamp(float(value), tz=timezone.utc).isoformat()
+    except (TypeError, ValueError):
+        return value
+
+
+def date_range(records):
+    first = last = None
+    for record in records:
+        try:
+            day = datetime.fromisoformat(parse_date(record["date"])).date()
+        except (KeyError, TypeError, ValueError):
+            continue
+        first = day if first is None else min(first, day)
+        last = day if last is None else max(last, day)
+    return first, last
+
+
+def copy_chunk(cursor, table: str, columns: list, rows: list):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def import_telemetry(table: str, path: str, file_format: str, chunk_size: int):
+    records = read_records(path, file_format)
+    first = next(records, None)
+    if first is None:
+        print("Nothing to import.")
+        return 0
+    columns = [name for name in COLUMNS[table] if name in first]
+    device_column = DEVICE_COLUMN[table]
+    if device_column not in columns:
+        raise SystemExit(f"Input has no {device_column} column")
+    if table == "flow_data" and "flow_rate" not in columns:
+        raise SystemExit("Input has no flow_rate column")
+
+    # Backfilled months get their partitions first, a day either side covers the database time zone
+    first_day, last_day = date_range(read_records(path, file_format))
+    if first_day:
+        ensure_partitions(table, first_day - timedelta(days=1), last_day + timedelta(days=1))
+
+    imported = 0
+    device_ids = set()
+    with engine.begin() as connection:
+        cursor = connection.connection.cursor()
+        chunk = []
+        for record in chain([first], records):
+            if "date" in record:
+                record["date"] = parse_date(record["date"])
+            # Empty CSV cells are stored as NULL, the same as missing NDJSON values
+            chunk.append([None if record.get(name) == "" else record.get(name) for name in columns])
+            device_ids.add(record[device_column])
+            if len(chunk) >= chunk_size:
+                copy_chunk(cursor, table, columns, chunk)
+                imported += len(chunk)
+                chunk = []
+                print(f"Imported {imported} rows...")
+        if chunk:
+            copy_chunk(cursor, table, columns, chunk)
+            imported += len(chunk)
+
+        # Single reconciliation pass in the same transaction as the import. Pump volumes are
+        # left alone, imported history was already drawn from the tank when it happened.
+        db = Session(bind=connection)
+        if table == "sensor_data":
+            devices.refresh_sensor_readings(db=db, sensor_ids=list(device_ids))
+            devices.refresh_last_sensor_data(db=db, sensor_ids=list(device_ids))
+        else:
+            devices.refresh_last_flow_data(db=db, pump_ids=list(device_ids))
+        db.flush()
+    print(f"Imported {imported} rows into {table}.")
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import sensor_data or flow_data exports with COPY")
+    parser.add_argument("table", choices=sorted(COLUMNS))
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["csv", "ndjson"], dest="file_format",
+                        help="Input format, detected from the file extension by default")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    args = parser.parse_args()
+    file_format = args.file_format or ("csv" if args.path.endswith(".csv") else "ndjson")
+    import_telemetry(args.table, args.path, file_format, args.chunk_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
@@ -6,12 +7,20 @@ from route.users import user_router
 from webroutes.admin import web_router
 from route.protected import base_router
 from route.api import api_router
+from db.database import SessionLocal
+from db.partitions import maintain_partitions, run_partition_maintenance
+from crud.rollups import run_rollup_pipeline
+from crud.images import chart_renderer
+from utils.config import settings
+from utils.ingest import registry, ingest_queue
 
 """ Uncomment following three lines if you are using render.com for hosting due to lack of alembic support """
 from db import models
 from db.database import engine
 
 models.Base.metadata.create_all(bind=engine)
+models.create_indexes(bind=engine)
+maintain_partitions()
 
 origins = ["*"]
 
@@ -22,6 +31,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -31,6 +41,56 @@ app.include_router(web_router)
 app.include_router(base_router, prefix="/base", tags=["base"])
 app.include_router(api_router, prefix="/api", tags=["API"])
 
+# Handles of the background loops, the event loop itself only keeps weak references
+app.state.background_tasks = []
 
 
+@app.on_event("startup")
+async def start_partition_maintenance():
+    app.state.background_tasks.append(asyncio.create_task(run_partition_maintenance()))
 
+
+@app.on_event("startup")
+async def start_rollup_pipeline():
+    if settings.rollup_interval > 0:
+        app.state.background_tasks.append(asyncio.create_task(run_rollup_pipeline(settings.rollup_interval)))
+
+
+@app.on_event("startup")
+async def start_chart_renderer():
+    if settings.chart_render_interval > 0:
+        app.state.background_tasks.append(asyncio.create_task(chart_renderer.run(settings.chart_render_interval)))
+
+
+@app.on_event("startup")
+async def start_ingest_queue():
+    if not settings.ingest_queue:
+        return
+    db = SessionLocal()
+    try:
+        registry.load(db)
+    finally:
+        db.close()
+    await ingest_queue.start()
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    tasks = app.state.background_tasks
+    for task in tasks:
+        task.cancel()
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            print(f"Background task failed: {result!r}")
+    tasks.clear()
+
+
+@app.on_event("shutdown")
+async def stop_ingest_queue():
+    if settings.ingest_queue:
+        await ingest_queue.stop()
+
+
+@app.on_event("shutdown")
+async def stop_chart_renderer():
+    chart_renderer.stop()
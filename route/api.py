@@ -1,20 +1,67 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Path, Query, Response, status
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 from datetime import datetime
+import os
+import tempfile
 
+from db import models
 from db.database import get_db
-from schema.devices import AddFlowData, AddSensorData, GetFlowData, SensorData, LogCreate, Logs, UpdateValveStatus, CurrentTime, Shifts, SystemID
-from crud import devices
+from schema.devices import AddFlowData, AddSensorData, GetFlowData, FlowDataBucket, SensorData, SensorDataBucket, LogCreate, Logs, UpdateValveStatus, CurrentTime, Shifts, SystemID
+from crud import devices, export, images
+from utils.config import settings
+from utils.ingest import registry, ingest_queue
+from utils.frames import sensor_frames, flow_frames
+from utils.pagination import decode_cursor
+from utils.downsample import chart_points
 
 
 api_router = APIRouter()
 
+BUCKET_PATTERN = r"^[1-9][0-9]*[mhd]$"
+AGGREGATE_PATTERN = r"^(avg|min|max|sum|count)$"
+
+
+def enqueue(kind: str, item):
+    if not ingest_queue.put(kind, item):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Ingestion queue is full. Please retry later"
+        )
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={"detail": "Accepted for processing"})
+
+
+def page_cursor(cursor: Optional[str]):
+    if not cursor:
+        return None
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid page cursor"
+        )
+
+
+def set_next_cursor(response: Response, next_cursor: Optional[str]):
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+
 """ Flow date routes """
 
 
 @api_router.post("/flowdata")
 def flow_data(flow: AddFlowData, db: Session = Depends(get_db)):
+    if settings.ingest_queue:
+        if not registry.known(db=db, kind="pump", dev_id=flow.pump_id):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="There is no such pump. Please check device ID"
+            )
+        return enqueue("flow", flow)
     pump_flow = devices.get_pump(db=db, pump_id=flow.pump_id)
     if not pump_flow:
         raise HTTPException(
@@ -22,19 +69,36 @@ def flow_data(flow: AddFlowData, db: Session = Depends(get_db)):
             detail="There is no such pump. Please check device ID"
         )
     try:
-        db_flow = devices.create_flow_data(db=db, flow=flow)
-
-        new_volume = pump_flow.current - flow.flow_rate
-        devices.update_pump_data(
-            db=db, pump_id=db_flow.pump_id, current=new_volume)
+        devices.create_flow_data_batch(db=db, flows=[flow])
         #devices.create_flow_image(db=db, pump_id=flow.pump_id) 
         return {"detail": "Successfully updated pump volume"}
     except:
         return {"detail": "Couldn't find pump in database"}
 
 
+@api_router.post("/flowdata/batch")
+def flow_data_batch(flow: List[AddFlowData] = Depends(flow_frames), db: Session = Depends(get_db)):
+    missing = devices.get_missing_pumps(
+        db=db, pump_ids=[data.pump_id for data in flow])
+    if missing:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"There is no such pump(s): {', '.join(sorted(missing))}. Please check device ID"
+        )
+    try:
+        stored = devices.create_flow_data_batch(db=db, flows=flow)
+        return {"detail": f"Successfully stored {stored} flow samples"}
+    except:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Something went wrong with connection to database"
+        )
+
+
 @api_router.get("/flowdata/{pump_id}", response_model=List[GetFlowData])
-def all_flow_data(pump_id: str, db: Session = Depends(get_db)):
+def all_flow_data(pump_id: str, response: Response, from_: Optional[datetime] = Query(None, alias="from"), to: Optional[datetime] = None,
+                  cursor: Optional[str] = None, limit: int = Query(1000, ge=1, le=10000), db: Session = Depends(get_db)):
+    page = page_cursor(cursor)
     pump = devices.get_pump(db=db, pump_id=pump_id)
     if not pump:
         raise HTTPException(
@@ -42,10 +106,30 @@ def all_flow_data(pump_id: str, db: Session = Depends(get_db)):
             detail="There is no such pump. Please check device ID"
         )
     try:
-        db_data = devices.get_all_flow_data(db=db, pump_id=pump_id)
+        db_data = devices.get_all_flow_data(db=db, pump_id=pump_id, start=from_, end=to)
         if not db_data:
             return {"detail": "There is no available data"}
-        return db_data.all()
+        rows, next_cursor = devices.paginate(db_data, models.FlowData.date, models.FlowData.id,
+                                             cursor=page, limit=limit)
+        set_next_cursor(response, next_cursor)
+        return rows
+    except:
+        return {"detail": "There is problems with database"}
+
+
+@api_router.get("/flowdata/{pump_id}/buckets", response_model=List[FlowDataBucket])
+def all_flow_data_buckets(pump_id: str, bucket: str = Query(..., regex=BUCKET_PATTERN), agg: str = Query("avg", regex=AGGREGATE_PATTERN),
+                          from_: Optional[datetime] = Query(None, alias="from"), to: Optional[datetime] = None,
+                          db: Session = Depends(get_db)):
+    pump = devices.get_pump(db=db, pump_id=pump_id)
+    if not pump:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="There is no such pump. Please check device ID"
+        )
+    try:
+        return devices.get_flow_buckets(db=db, pump_id=pump_id, bucket=devices.parse_bucket(bucket),
+                                        agg=agg, start=from_, end=to).all()
     except:
         return {"detail": "There is problems with database"}
 
@@ -72,6 +156,13 @@ def last_flow_data(pump_id: str, db: Session = Depends(get_db)):
 
 @api_router.post("/sensordata")
 def sensor_data(sensor_data: AddSensorData, db: Session = Depends(get_db)):
+    if settings.ingest_queue:
+        if not registry.known(db=db, kind="sensor", dev_id=sensor_data.sensor_id):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="There is no such sensor. Please check device ID"
+            )
+        return enqueue("sensor", sensor_data)
     try:
         new_data = devices.create_sensor_data(db=db, sensor=sensor_data)
         sensor = devices.get_sensor(db=db, sensor_id=new_data.sensor_id)
@@ -93,8 +184,29 @@ def sensor_data(sensor_data: AddSensorData, db: Session = Depends(get_db)):
         return {"detail": "Couldn't find sensor in database"}
 
 
+@api_router.post("/sensordata/batch")
+def sensor_data_batch(sensor_data: List[AddSensorData] = Depends(sensor_frames), db: Session = Depends(get_db)):
+    missing = devices.get_missing_sensors(
+        db=db, sensor_ids=[data.sensor_id for data in sensor_data])
+    if missing:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"There is no such sensor(s): {', '.join(sorted(missing))}. Please check device ID"
+        )
+    try:
+        stored = devices.create_sensor_data_batch(db=db, sensors=sensor_data)
+        return {"detail": f"Successfully stored {stored} sensor readings"}
+    except:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Something went wrong with connection to database"
+        )
+
+
 @api_router.get("/sensordata/{sensor_id}", response_model=List[SensorData])
-def all_sensor_data(sensor_id: str, db: Session = Depends(get_db)):
+def all_sensor_data(sensor_id: str, response: Response, from_: Optional[datetime] = Query(None, alias="from"), to: Optional[datetime] = None,
+                    cursor: Optional[str] = None, limit: int = Query(1000, ge=1, le=10000), db: Session = Depends(get_db)):
+    page = page_cursor(cursor)
     sensor = devices.get_sensor(db=db, sensor_id=sensor_id)
     if not sensor:
         raise HTTPException(
@@ -102,10 +214,30 @@ def all_sensor_data(sensor_id: str, db: Session = Depends(get_db)):
             detail="There is no such sensor. Please check device ID"
         )
     try:
-        db_data = devices.get_all_sensor_data(db=db, sensor_id=sensor_id)
+        db_data = devices.get_all_sensor_data(db=db, sensor_id=sensor_id, start=from_, end=to)
         if not db_data:
             return {"detail": "There is no available data"}
-        return db_data.all()
+        rows, next_cursor = devices.paginate(db_data, models.SensorData.date, models.SensorData.id,
+                                             cursor=page, limit=limit)
+        set_next_cursor(response, next_cursor)
+        return rows
+    except:
+        return {"detail": "There is problems with database"}
+
+
+@api_router.get("/sensordata/{sensor_id}/buckets", response_model=List[SensorDataBucket])
+def all_sensor_data_buckets(sensor_id: str, bucket: str = Query(..., regex=BUCKET_PATTERN), agg: str = Query("avg", regex=AGGREGATE_PATTERN),
+                            from_: Optional[datetime] = Query(None, alias="from"), to: Optional[datetime] = None,
+                            db: Session = Depends(get_db)):
+    sensor = devices.get_sensor(db=db, sensor_id=sensor_id)
+    if not sensor:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="There is no such sensor. Please check device ID"
+        )
+    try:
+        return devices.get_sensor_buckets(db=db, sensor_id=sensor_id, bucket=devices.parse_bucket(bucket),
+                                          agg=agg, start=from_, end=to).all()
     except:
         return {"detail": "There is problems with database"}
 
@@ -182,6 +314,10 @@ def change_valve_status(valve_id: str, valve: UpdateValveStatus, db: Session = D
 
 @api_router.post("/log/{id}")
 def create_log(log: LogCreate, id: str, db: Session = Depends(get_db)):
+    if settings.ingest_queue:
+        if not registry.known_any(db=db, dev_id=id):
+            return {"detail": "Couldn't find device in database. Check if input is valid!"}
+        return enqueue("log", log)
     pump = devices.get_pump(db=db, pump_id=id)
     valve = devices.get_valve(db=db, valve_id=id)
     sensor = devices.get_sensor(db=db, sensor_id=id)
@@ -193,7 +329,9 @@ def create_log(log: LogCreate, id: str, db: Session = Depends(get_db)):
 
 
 @api_router.get("/systemlogs", response_model=List[List[Logs]])
-def get_system_logs(system_id: int, db: Session = Depends(get_db)):
+def get_system_logs(system_id: int, response: Response, cursor: Optional[str] = None, limit: int = Query(100, ge=1, le=1000),
+                    db: Session = Depends(get_db)):
+    page = page_cursor(cursor)
     system = devices.get_system(db=db, system_id=system_id)
     if not system:
         raise HTTPException(
@@ -201,24 +339,129 @@ def get_system_logs(system_id: int, db: Session = Depends(get_db)):
             detail="Please select active system ID"
         )
 
-    pump_logs = []
-    valve_logs = []
-    sensor_logs = []
-    for pump in system.system_pumps:
-        pumps_logs = devices.get_dev_logs(db=db, dev_id=pump.pump_id)
-        for pump_log in pumps_logs:
-            pump_logs.append(pump_log)
-    for valve in system.system_valves:
-        valves_logs = devices.get_dev_logs(db=db, dev_id=valve.valve_id)
-        for valve_log in valves_logs:
-            valve_logs.append(valve_log)
-    for sensor in system.system_sensors:
-        sensors_logs = devices.get_dev_logs(db=db, dev_id=sensor.sensor_id)
-        for sensor_log in sensors_logs:
-            sensor_logs.append(sensor_log)
+    logs, next_cursor = devices.get_system_logs(db=db, system_id=system_id, cursor=page, limit=limit)
+    set_next_cursor(response, next_cursor)
+    pump_logs = [log for log in logs if log.dev_type == "pump"]
+    valve_logs = [log for log in logs if log.dev_type == "valve"]
+    sensor_logs = [log for log in logs if log.dev_type == "sensor"]
     return [pump_logs, valve_logs, sensor_logs]
 
 
+""" Pre-shaped chart series, the browser builds the figure """
+
+
+@api_router.get("/chartdata/flow/{pump_id}")
+def flow_chart_data(pump_id: str, width: int = 1200, db: Session = Depends(get_db)):
+    pump = devices.get_pump(db=db, pump_id=pump_id)
+    if not pump:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="There is no such pump. Please check device ID"
+        )
+    points = chart_points(width)
+    return Response(content=devices.chart_json(db=db, kind="flow", device_id=pump_id, points=points),
+                    media_type="application/json")
+
+
+@api_router.get("/chartdata/sensor/{sensor_id}")
+def sensor_chart_data(sensor_id: str, width: int = 1200, db: Session = Depends(get_db)):
+    sensor = devices.get_sensor(db=db, sensor_id=sensor_id)
+    if not sensor:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="There is no such sensor. Please check device ID"
+        )
+    points = chart_points(width)
+    return Response(content=devices.chart_json(db=db, kind="sensor", device_id=sensor_id, points=points),
+                    media_type="application/json")
+
+
+@api_router.get("/chartimage/{kind}/{device_id}")
+def chart_image(kind: str = Path(..., regex="^(flow|sensor)$"), device_id: str = Path(...),
+                format: str = Query("png", regex="^(png|svg)$")):
+    path = images.current_image(kind=kind, device_id=device_id, image_format=format)
+    if not path:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="There is no rendered chart for this device yet"
+        )
+    return FileResponse(path, headers={"Cache-Control": "no-cache"})
+
+
+""" Streaming exports of device history """
+
+
+@api_router.get("/export/sensordata/{sensor_id}")
+def export_sensor_data(sensor_id: str, format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+                       from_: Optional[datetime] = Query(None, alias="from"), to: Optional[datetime] = None,
+                       db: Session = Depends(get_db)):
+    sensor = devices.get_sensor(db=db, sensor_id=sensor_id)
+    if not sensor:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="There is no such sensor. Please check device ID"
+        )
+    statement = export.sensor_export(sensor_id=sensor_id, start=from_, end=to)
+    return StreamingResponse(export.export_stream(statement, format), media_type=export.MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f"attachment; filename={sensor_id}.{format}"})
+
+
+@api_router.get("/export/flowdata/{pump_id}")
+def export_flow_data(pump_id: str, format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+                     from_: Optional[datetime] = Query(None, alias="from"), to: Optional[datetime] = None,
+                     db: Session = Depends(get_db)):
+    pump = devices.get_pump(db=db, pump_id=pump_id)
+    if not pump:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="There is no such pump. Please check device ID"
+        )
+    statement = export.flow_export(pump_id=pump_id, start=from_, end=to)
+    return StreamingResponse(export.export_stream(statement, format), media_type=export.MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f"attachment; filename={pump_id}.{format}"})
+
+
+@api_router.get("/export/system/{system_id}/{table}")
+def export_system_columnar(system_id: int, table: str, format: str = Query("parquet", regex="^(parquet|arrow)$"),
+                           from_: Optional[datetime] = Query(None, alias="from"), to: Optional[datetime] = None,
+                           db: Session = Depends(get_db)):
+    if table not in export.SYSTEM_EXPORTS:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Please select sensordata or flowdata"
+        )
+    system = devices.get_system(db=db, system_id=system_id)
+    if not system:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Please select active system ID"
+        )
+    statement = export.SYSTEM_EXPORTS[table](system_id=system_id, start=from_, end=to)
+    fd, path = tempfile.mkstemp(suffix=f".{format}")
+    os.close(fd)
+    try:
+        export.write_columnar(statement, path, format)
+    except ImportError:
+        os.remove(path)
+        raise HTTPException(
+            status_code=status.HTTP_501_NOT_IMPLEMENTED,
+            detail="Columnar export needs pyarrow installed on the server"
+        )
+    except:
+        os.remove(path)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Something went wrong with connection to database"
+        )
+    return FileResponse(path, media_type=export.COLUMNAR_FORMATS[format], filename=f"{system.systemID}-{table}.{format}",
+                        background=BackgroundTask(os.remove, path))
+
+
+@api_router.get("/ingest/stats")
+def ingest_stats():
+    return {"enabled": settings.ingest_queue, **ingest_queue.stats()}
+
+
 """ API routes for getting setting """
 
 
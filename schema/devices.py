@@ -45,6 +45,18 @@ class GetFlowData(BaseModel):
         }
 
 
+class FlowDataBucket(BaseModel):
+    date: datetime
+    flow_rate: Optional[float]
+    count: int
+
+    class Config:
+        orm_mode = True
+        json_encoders = {
+            datetime: lambda v: v.timestamp(),
+        }
+
+
 # Valve's schemas
 class ValveBase(BaseModel):
     valve_id: str
@@ -130,6 +142,20 @@ class SensorData(BaseModel):
         }
 
 
+class SensorDataBucket(BaseModel):
+    date: datetime
+    level_1: Optional[float]
+    level_2: Optional[float]
+    level_3: Optional[float]
+    count: int
+
+    class Config:
+        orm_mode = True
+        json_encoders = {
+            datetime: lambda v: v.timestamp(),
+        }
+
+
 class SensorControler(BaseModel):
     section_id: int
     sensor_id: Optional[str]
@@ -329,6 +355,7 @@ class LogCreate(BaseModel):
 
 class Logs(LogCreate):
     date: datetime
+    dev_type: Optional[str] = None
 
     class Config:
         orm_mode = True
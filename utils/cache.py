@@ -0,0 +1,219 @@
+import threading
+import time
+from collections import OrderedDict
+
+from utils.config import settings
+
+
+class LRUCache:
+    """ Size-capped LRU of serialized values, entries are grouped per device for invalidation """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value: str):
+        # key starts with (kind, device_id, ...)
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = value
+            self._devices.setdefault(key[:2], set()).add(key)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, kind: str, device_id: str):
+        with self._lock:
+            for key in self._devices.pop((kind, device_id), set()):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._devices.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        value = self._entries.pop(key, None)
+        if value is None:
+            return
+        self.size -= len(value)
+        keys = self._devices.get(key[:2])
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del self._devices[key[:2]]
+
+
+class SnapshotCache:
+    """ Assembled page contexts per system, dropped whenever anything in that system is written """
+
+    def __init__(self, ttl: float):
+        # The TTL bounds staleness from writes made by other worker processes
+        self.ttl = ttl
+        self._entries = {}
+        self._members = {}
+        self._written = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def get(self, system_id: int):
+        with self._lock:
+            entry = self._entries.get(system_id)
+            if entry is None:
+                return None
+            expires, snapshot, _ = entry
+            if expires < time.monotonic():
+                self._remove(system_id)
+                return None
+            return snapshot
+
+    def version(self):
+        """ Taken before building a snapshot and handed back to set() """
+        with self._lock:
+            return self._tick
+
+    def set(self, system_id: int, snapshot, members, version: int):
+        # members are (kind, key) pairs such as ("device", "Px01") or ("shift", 3) found in the system
+        if self.ttl <= 0:
+            return
+        members = set(members)
+        with self._lock:
+            # A write that landed while the snapshot was built may be missing from it, serve it once but don't keep it
+            if any(self._written.get(member, 0) > version for member in members | {("system", system_id)}):
+                return
+            self._remove(system_id)
+            self._entries[system_id] = (time.monotonic() + self.ttl, snapshot, members)
+            for member in members:
+                self._members[member] = system_id
+
+    def invalidate(self, system_id: int):
+        with self._lock:
+            self._mark(("system", system_id))
+            self._remove(system_id)
+
+    def invalidate_member(self, kind: str, key):
+        with self._lock:
+            self._mark((kind, key))
+            system_id = self._members.get((kind, key))
+            if system_id is not None:
+                self._remove(system_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._members.clear()
+
+    def _mark(self, member):
+        self._tick += 1
+        self._written[member] = self._tick
+
+    def _remove(self, system_id: int):
+        entry = self._entries.pop(system_id, None)
+        if entry is None:
+            return
+        for member in entry[2]:
+            if self._members.get(member) == system_id:
+                del self._members[member]
+
+
+class VersionedValue:
+    """ One shared value, rebuilt on the next read after bump() or once it is older than ttl """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.version = 0
+        self._value = None
+        self._built = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, build):
+        with self._lock:
+            version = self.version
+            if self._built == version and self._expires > time.monotonic():
+                return self._value
+        value = build()
+        with self._lock:
+            # A bump while building means the value may already be stale, serve it once but don't keep it
+            if self.version == version:
+                self._value = value
+                self._built = version
+                self._expires = time.monotonic() + self.ttl
+        return value
+
+    def bump(self):
+        with self._lock:
+            self.version += 1
+
+
+class TTLCache:
+    """ Entry-capped LRU with per-entry expiry, entries are grouped for invalidation """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value, _ = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, group, ttl: float = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, value, group)
+            self._groups.setdefault(group, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, group):
+        with self._lock:
+            for key in self._groups.pop(group, set()):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._groups.clear()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self._groups.get(entry[2])
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del self._groups[entry[2]]
+
+
+chart_cache = LRUCache(max_bytes=settings.chart_cache_bytes)
+dashboard_cache = SnapshotCache(ttl=settings.dashboard_cache_ttl)
+user_list_cache = VersionedValue(ttl=settings.user_list_cache_ttl)
+user_cache = TTLCache(max_entries=settings.user_cache_entries, ttl=settings.user_cache_ttl)
@@ -13,6 +13,37 @@ class Settings(BaseSettings):
     
     email : str 
     password: str
+
+    ingest_queue: bool = False
+    ingest_queue_size: int = 10000
+    ingest_batch_size: int = 500
+    ingest_flush_interval: float = 1.0
+    ingest_retries: int = 5
+    ingest_retry_max_delay: float = 60
+
+    telemetry_partitions_ahead: int = 3
+    telemetry_retention_months: int = 0
+    telemetry_drop_expired: bool = False
+
+    rollup_interval: float = 300
+    rollup_lag: float = 900
+    chart_raw_days: int = 14
+    chart_hourly_days: int = 180
+    chart_cache_bytes: int = 64 * 1024 * 1024
+    chart_consumption_days: int = 90
+    system_consumption_days: int = 7
+    system_log_limit: int = 200
+    system_query_budget: int = 25
+    dashboard_cache_ttl: float = 60
+    live_keepalive: float = 15
+    user_list_cache_ttl: float = 300
+    user_cache_entries: int = 1024
+    user_cache_ttl: float = 60
+    navbar_alert_limit: int = 20
+    chart_render_interval: float = 600
+    chart_render_workers: int = 2
+    chart_image_width: int = 1200
+    chart_image_height: int = 500
     
     
     class Config:
@@ -0,0 +1,51 @@
+import numpy as np
+
+
+""" Largest-Triangle-Three-Buckets downsampling for chart series """
+
+MIN_POINTS = 100
+MAX_POINTS = 4000
+
+
+def chart_points(width: int):
+    # Roughly one point per horizontal pixel of the chart
+    return max(MIN_POINTS, min(MAX_POINTS, width))
+
+
+def as_numbers(values):
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype("datetime64[ns]").astype(np.int64).astype(float)
+    if values.dtype == object:
+        return np.array([value.timestamp() if hasattr(value, "timestamp") else value for value in values], dtype=float)
+    return values.astype(float)
+
+
+def lttb_indices(x, y, threshold: int):
+    x = as_numbers(x)
+    y = as_numbers(y)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    # threshold - 2 buckets between the fixed first and last points
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    selected = np.empty(threshold, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = np.nanmean(y[end:next_end]) if not np.isnan(y[end:next_end]).all() else y[a]
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(np.nan_to_num(areas, nan=-1.0)))
+        selected[bucket + 1] = a
+    return selected
+
+
+def downsample_indices(x, series, threshold: int):
+    """ Union of the LTTB picks of every series so they can share one x axis """
+    if len(x) <= threshold:
+        return np.arange(len(x))
+    picks = [lttb_indices(x, y, threshold) for y in series]
+    return np.unique(np.concatenate(picks))
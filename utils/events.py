@@ -0,0 +1,76 @@
+import asyncio
+import json
+import threading
+from typing import Iterable
+
+
+class Subscription:
+    def __init__(self, device_ids: Iterable[str], queue_size: int):
+        self.device_ids = set(device_ids)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+    def offer(self, event: dict):
+        # A browser that stopped reading loses events instead of holding up the writers
+        if not self.queue.full():
+            self.queue.put_nowait(event)
+
+
+class EventBroker:
+    """ In-process fan-out of device changes to the live dashboards watching them """
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, device_ids: Iterable[str]):
+        subscription = Subscription(device_ids, self.queue_size)
+        with self._lock:
+            for device_id in subscription.device_ids:
+                self._devices.setdefault(device_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            for device_id in subscription.device_ids:
+                subscriptions = self._devices.get(device_id)
+                if subscriptions:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self._devices[device_id]
+
+    def publish(self, device_id: str, event: dict):
+        # Called from the threads that commit the writes, delivered on each subscriber's loop
+        with self._lock:
+            subscriptions = list(self._devices.get(device_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.offer, event)
+            except RuntimeError:
+                # Loop already closed
+                self.unsubscribe(subscription)
+
+
+def format_event(event: dict):
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+async def event_stream(request, device_ids: Iterable[str], keepalive: float):
+    """ Server-Sent Events body for one dashboard, subscribed for as long as the browser listens """
+    subscription = broker.subscribe(device_ids)
+    try:
+        yield "retry: 5000\n\n"
+        while not await request.is_disconnected():
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                # Comment line, keeps proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                continue
+            yield format_event(event)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+broker = EventBroker()
@@ -0,0 +1,107 @@
+import json
+import math
+import struct
+from datetime import datetime, timezone
+from typing import List
+
+from fastapi import HTTPException, Request, status
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError, parse_obj_as
+
+from schema.devices import AddFlowData, AddSensorData
+
+
+""" Binary telemetry frames for low-bandwidth gateways
+
+    A request body is a plain concatenation of fixed-size little-endian frames:
+    sensor frame (49 bytes): sensor_id 25s (NUL padded), bat_level, level_1, level_2, level_3,
+                             temperature, moisture as float32
+    flow frame (37 bytes):   pump_id 25s (NUL padded), flow_rate float32, date float64 unix
+                             timestamp (0 means time of arrival)
+"""
+FRAME_CONTENT_TYPE = "application/octet-stream"
+SENSOR_FRAME = struct.Struct("<25s6f")
+FLOW_FRAME = struct.Struct("<25sfd")
+
+
+def decode_frames(body: bytes, frame: struct.Struct):
+    view = memoryview(body)
+    if not view.nbytes or view.nbytes % frame.size:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Body must be a sequence of {frame.size} byte frames"
+        )
+    return struct.iter_unpack(frame.format, view)
+
+
+def device_id(raw: bytes):
+    return raw.rstrip(b"\0").decode("utf-8", "replace")
+
+
+def invalid_frame(index: int, reason: str):
+    return HTTPException(
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        detail=f"Frame {index}: {reason}"
+    )
+
+
+def finite(index: int, **values):
+    # construct() skips validation, NaN and infinity would be stored as they are
+    for name, value in values.items():
+        if not math.isfinite(value):
+            raise invalid_frame(index, f"{name} is not a finite number")
+    return values
+
+
+def frame_date(index: int, timestamp: float, now: datetime):
+    if not timestamp:
+        return now
+    try:
+        return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        raise invalid_frame(index, "date is not a valid unix timestamp")
+
+
+def decode_sensor_frames(body: bytes):
+    return [AddSensorData.construct(sensor_id=device_id(sensor_id),
+                                    **finite(index, bat_level=bat_level, level_1=level_1, level_2=level_2,
+                                             level_3=level_3, temperature=temperature, moisture=moisture))
+            for index, (sensor_id, bat_level, level_1, level_2, level_3, temperature, moisture)
+            in enumerate(decode_frames(body, SENSOR_FRAME))]
+
+
+def decode_flow_frames(body: bytes):
+    now = datetime.now(timezone.utc)
+    return [AddFlowData.construct(pump_id=device_id(pump_id), **finite(index, flow_rate=flow_rate),
+                                  date=frame_date(index, date, now))
+            for index, (pump_id, flow_rate, date) in enumerate(decode_frames(body, FLOW_FRAME))]
+
+
+def is_binary(request: Request):
+    return request.headers.get("content-type", "").split(";")[0].strip() == FRAME_CONTENT_TYPE
+
+
+def parse_json(body: bytes, model):
+    try:
+        return parse_obj_as(List[model], json.loads(body))
+    except ValidationError as error:
+        raise RequestValidationError(error.errors())
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Body is not valid JSON"
+        )
+
+
+async def sensor_frames(request: Request) -> List[AddSensorData]:
+    body = await request.body()
+    if is_binary(request):
+        return decode_sensor_frames(body)
+    return parse_json(body, AddSensorData)
+
+
+async def flow_frames(request: Request) -> List[AddFlowData]:
+    body = await request.body()
+    if is_binary(request):
+        return decode_flow_frames(body)
+    return parse_json(body, AddFlowData)
@@ -0,0 +1,185 @@
+import asyncio
+import queue
+import threading
+import time
+
+from sqlalchemy.orm import Session
+
+from crud import devices
+from db import models
+from db.database import SessionLocal
+from utils.config import settings
+
+
+class DeviceRegistry:
+    """ In-memory set of known device IDs so queued ingestion can be validated without a query """
+
+    def __init__(self):
+        self._devices = {"pump": set(), "valve": set(), "sensor": set()}
+        self._lock = threading.Lock()
+
+    def load(self, db: Session):
+        pumps = {pump_id for pump_id, in db.query(models.Pump.pump_id).all()}
+        valves = {valve_id for valve_id, in db.query(models.Valve.valve_id).all()}
+        sensors = {sensor_id for sensor_id, in db.query(models.Sensor.sensor_id).all()}
+        with self._lock:
+            self._devices = {"pump": pumps, "valve": valves, "sensor": sensors}
+
+    def known(self, db: Session, kind: str, dev_id: str):
+        if dev_id in self._devices[kind]:
+            return True
+        # Devices added after startup are picked up on first use
+        getters = {"pump": devices.get_pump, "valve": devices.get_valve, "sensor": devices.get_sensor}
+        if not getters[kind](db, dev_id):
+            return False
+        with self._lock:
+            self._devices[kind].add(dev_id)
+        return True
+
+    def known_any(self, db: Session, dev_id: str):
+        return any(self.known(db, kind, dev_id) for kind in self._devices)
+
+
+class IngestQueue:
+    """ Bounded write-behind queue drained into Postgres by a background task """
+
+    def __init__(self, maxsize: int, batch_size: int, flush_interval: float, retries: int = 5,
+                 retry_max_delay: float = 60):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_max_delay = retry_max_delay
+        self.accepted = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._retrying = []
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            retrying = sum(len(items) for _, _, _, items in self._retrying)
+        return {"depth": self.depth, "retrying": retrying, "accepted": self.accepted, "dropped": self.dropped,
+                "written": self.written, "failed": self.failed}
+
+    def put(self, kind: str, item):
+        try:
+            self._queue.put_nowait((kind, item))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.accepted += 1
+        if self._loop and self.depth >= self.batch_size:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return True
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._loop.run_in_executor(None, self.flush, True)
+
+    async def _run(self):
+        while True:
+            # A failed flush must not end the task, queued records would never be written again
+            try:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                await self._loop.run_in_executor(None, self.flush)
+            except Exception as error:
+                print(f"Ingest queue flush failed: {error}")
+
+    def flush(self, final: bool = False):
+        # On shutdown every pending retry gets its last attempt right away
+        self._retry_due(final)
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            self._write(batch, final)
+
+    def _retry_due(self, final: bool):
+        now = time.monotonic()
+        with self._lock:
+            due = [retry for retry in self._retrying if final or retry[0] <= now]
+            self._retrying = [retry for retry in self._retrying if not (final or retry[0] <= now)]
+        for _, attempt, kind, items in due:
+            self._write_items(kind, items, attempt, final)
+
+    def _write(self, batch, final: bool = False):
+        grouped = {"sensor": [], "flow": [], "log": []}
+        for kind, item in batch:
+            grouped[kind].append(item)
+        for kind, items in grouped.items():
+            if items:
+                self._write_items(kind, items, 0, final)
+
+    def _write_items(self, kind: str, items, attempt: int, final: bool):
+        db = SessionLocal()
+        try:
+            written = self._write_group(db, kind, items)
+        except Exception as error:
+            db.rollback()
+            self._retry(kind, items, attempt, final, error)
+            return
+        finally:
+            db.close()
+        with self._lock:
+            self.written += written
+            self.failed += len(items) - written
+
+    def _retry(self, kind: str, items, attempt: int, final: bool, error: Exception):
+        if final or attempt >= self.retries:
+            print(f"Ingest queue dropped {len(items)} {kind} records after {attempt + 1} attempts: {error}")
+            with self._lock:
+                self.failed += len(items)
+            return
+        delay = min(self.flush_interval * 2 ** attempt, self.retry_max_delay)
+        print(f"Ingest queue failed to write {len(items)} {kind} records, retrying in {delay:.1f}s: {error}")
+        with self._lock:
+            self._retrying.append((time.monotonic() + delay, attempt + 1, kind, items))
+
+    def _write_group(self, db: Session, kind: str, items):
+        # Devices may have been deleted while their records waited in the queue
+        if kind == "sensor":
+            missing = devices.get_missing_sensors(db=db, sensor_ids=[data.sensor_id for data in items])
+            return devices.create_sensor_data_batch(
+                db=db, sensors=[data for data in items if data.sensor_id not in missing])
+        if kind == "flow":
+            missing = devices.get_missing_pumps(db=db, pump_ids=[data.pump_id for data in items])
+            return devices.create_flow_data_batch(
+                db=db, flows=[data for data in items if data.pump_id not in missing])
+        return devices.create_logs_batch(db=db, logs=items)
+
+
+registry = DeviceRegistry()
+ingest_queue = IngestQueue(maxsize=settings.ingest_queue_size, batch_size=settings.ingest_batch_size,
+                           flush_interval=settings.ingest_flush_interval, retries=settings.ingest_retries,
+                           retry_max_delay=settings.ingest_retry_max_delay)
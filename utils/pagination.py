@@ -0,0 +1,20 @@
+import base64
+import json
+from datetime import datetime
+
+
+""" Opaque keyset cursors over (date, id) """
+
+
+def encode_cursor(date: datetime, id: int):
+    raw = json.dumps([date.isoformat(), id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        date, id = json.loads(raw)
+        return datetime.fromisoformat(date), int(id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
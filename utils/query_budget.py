@@ -0,0 +1,40 @@
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from db.database import engine
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+class QueryBudget:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.count = 0
+
+
+_budget: ContextVar = ContextVar("query_budget", default=None)
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    budget = _budget.get()
+    if budget is None:
+        return
+    budget.count += 1
+    if budget.count > budget.limit:
+        raise QueryBudgetExceeded(f"Request issued more than {budget.limit} queries: {statement[:200]}")
+
+
+def query_budget(limit: int):
+    """ Route dependency failing the request once it runs more than `limit` statements, 0 disables it """
+
+    # Async so the budget is set in the request task itself, sync dependencies and the endpoint
+    # run in threads that copy this context and so share the same counter
+    async def dependency():
+        if limit > 0:
+            _budget.set(QueryBudget(limit))
+
+    return dependency
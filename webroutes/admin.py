@@ -1,22 +1,36 @@
 from fastapi import APIRouter, Depends, Request
+from sqlalchemy import inspect
 from sqlalchemy.orm import Session
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from typing import Optional
 import json
-import plotly
 
 
 from schema.users import User
 from crud import devices
 from crud.login import get_current_user
-from crud.users import get_users, alerts, get_subscribers
+from crud.users import alerts, unread_alerts, get_sidebar_users, get_subscribers
 from db.database import get_db
+from utils.cache import dashboard_cache
+from utils.config import settings
+from utils.events import event_stream
+from utils.pagination import decode_cursor
+from utils.query_budget import query_budget
 
 
 web_router = APIRouter(include_in_schema=False)
 templates = Jinja2Templates(directory="templates")
 
 
+def page_context(db: Session, current_user: User):
+    """ Navbar and sidebar context shared by the web pages """
+    # Only non-admin users get the alerts dropdown, the badge counts the same capped list
+    user_alerts = [] if current_user.admin else unread_alerts(db=db, user=current_user.username,
+                                                              limit=settings.navbar_alert_limit)
+    return {"current_user": current_user, "users": get_sidebar_users(db=db), "unread_alerts": user_alerts}
+
+
 @web_router.get("/", response_class=HTMLResponse)
 def home(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
@@ -35,72 +49,50 @@ def reset_password(request: Request):
 @web_router.get("/profile", response_model=User)
 def current_user(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
     current_user = current_user
-    alerts = []
-    for alert in current_user.alerts:
-        if not alert.read:
-            alerts.append(alert)
-    users = get_users(db=db)
     if not current_user:
         return {"detail": "You are not logged in"}
-    return templates.TemplateResponse("profile.html", {"request": request, "current_user": current_user, "alerts": alerts, "users": users})
+    return templates.TemplateResponse("profile.html", {"request": request, **page_context(db=db, current_user=current_user)})
 
 
 @web_router.get("/flow/{id}")
 def get_flow_figures(id: str, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
     user = current_user
-    alerts = []
-    for alert in current_user.alerts:
-        if not alert.read:
-            alerts.append(alert)
-    users = get_users(db=db)
-    data = devices.show_flow_fig(id=id, db=db)
-    graphJSON = json.dumps(data, cls=plotly.utils.PlotlyJSONEncoder)
-    return templates.TemplateResponse("fig.html", {"request": request, "graphJSON": graphJSON, "current_user": user,
-                                                   "alerts": alerts, "users": users})
+    return templates.TemplateResponse("fig.html", {"request": request, "chart_url": f"/api/chartdata/flow/{id}",
+                                                   **page_context(db=db, current_user=user)})
 
 
 @web_router.get("/sensor/{id}")
 def get_flow_figures(id: str, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
     user = current_user
-    alerts = []
-    for alert in current_user.alerts:
-        if not alert.read:
-            alerts.append(alert)
-    users = get_users(db=db)
-    data = devices.show_sensor_fig(id=id, db=db)
-    graphJSON = json.dumps(data, cls=plotly.utils.PlotlyJSONEncoder)
-    return templates.TemplateResponse("fig.html", {"request": request, "graphJSON": graphJSON, "current_user": user,
-                                                   "alerts": alerts, "users": users})
+    return templates.TemplateResponse("fig.html", {"request": request, "chart_url": f"/api/chartdata/sensor/{id}",
+                                                   **page_context(db=db, current_user=user)})
 
 
 @web_router.get("/systems")
 def admin_page(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    users = get_users(db=db)
     if not current_user:
         return {"detail": "You are not logged in"}
     if not current_user.admin:
         return {"detali": "You are not authorized"}
     systems = devices.get_systems(db=db)
-    return templates.TemplateResponse("systems.html", {"request": request, "systems": systems, "current_user": current_user,
-                                                       "users": users})
+    return templates.TemplateResponse("systems.html", {"request": request, "systems": systems,
+                                                       **page_context(db=db, current_user=current_user)})
 
 
 @web_router.get("/pumps")
 def admin_page(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    users = get_users(db=db)
     if not current_user:
         return {"detail": "You are not logged in"}
     if not current_user.admin:
         return {"detali": "You are not authorized"}
     systems = devices.get_systems(db=db)
     pumps = devices.get_pumps(db=db)
-    return templates.TemplateResponse("pumps.html", {"request": request, "systems": systems, "pumps": pumps, "current_user": current_user,
-                                                     "users": users})
+    return templates.TemplateResponse("pumps.html", {"request": request, "systems": systems, "pumps": pumps,
+                                                     **page_context(db=db, current_user=current_user)})
 
 
 @web_router.get("/valves")
 def admin_page(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    users = get_users(db=db)
     if not current_user:
         return {"detail": "You are not logged in"}
     if not current_user.admin:
@@ -109,108 +101,145 @@ def admin_page(request: Request, db: Session = Depends(get_db), current_user: Us
     valves = devices.get_valves(db=db)
     sections = devices.get_sections(db=db)
     return templates.TemplateResponse("valves.html", {"request": request, "systems": systems, "sections": sections,
-                                                      "valves": valves, "current_user": current_user, "users": users})
+                                                      "valves": valves, **page_context(db=db, current_user=current_user)})
 
 
 @web_router.get("/sensors")
 def admin_page(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    users = get_users(db=db)
-    sensor_data = []
     if not current_user:
         return {"detail": "You are not logged in"}
     if not current_user.admin:
         return {"detali": "You are not authorized"}
     systems = devices.get_systems(db=db)
     sensors = devices.get_sensors(db=db)
-    for sensor in sensors:
-        data = devices.get_sensor_data(db=db, sensor_id=sensor.sensor_id)
-        sensor_data.append(data)
+    latest = devices.get_sensors_data(db=db, sensor_ids=[sensor.sensor_id for sensor in sensors])
+    sensor_data = [latest[sensor.sensor_id] for sensor in sensors if sensor.sensor_id in latest]
 
     return templates.TemplateResponse("sensors.html", {"request": request, "systems": systems, "sensors": sensors,
-                                                       "current_user": current_user, "users": users, "sensor_data": sensor_data})
+                                                       "sensor_data": sensor_data, **page_context(db=db, current_user=current_user)})
 
 
 @web_router.get("/logs")
-def admin_page(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    users = get_users(db=db)
+def admin_page(request: Request, cursor: Optional[str] = None, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
     if not current_user:
         return {"detail": "You are not logged in"}
     if not current_user.admin:
         return {"detali": "You are not authorized"}
-    logs = devices.get_logs(db=db)
+    try:
+        page = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        page = None
+    logs, next_cursor = devices.get_logs(db=db, cursor=page)
     notifications = alerts(db=db)
     subsctiptions = get_subscribers(db=db)
     return templates.TemplateResponse("logs.html", {"request": request, "logs": logs, "alerts": notifications,
-                                                    "subscriptions": subsctiptions, "current_user": current_user, "users": users})
+                                                    "subscriptions": subsctiptions, "next_cursor": next_cursor,
+                                                    **page_context(db=db, current_user=current_user)})
 
 
-@web_router.get("/system/{id}")
-def system(id: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    users = get_users(db=db)
-    alerts = []
-    for alert in current_user.alerts:
-        if not alert.read:
-            alerts.append(alert)
-    pump_logs = []
-    valve_logs = []
-    sensor_logs = []
+def plain(instance, **relationships):
+    """ Column values of an ORM instance as a dict, usable after its session is closed """
+    row = {column.key: getattr(instance, column.key) for column in inspect(instance).mapper.column_attrs}
+    row.update(relationships)
+    return row
+
+
+def plain_system(system):
+    shifts = [plain(shift, shift_timers=[plain(timer) for timer in shift.shift_timers],
+                    shifts_sections=[plain(section, section_sensors=[plain(controler) for controler in section.section_sensors])
+                                     for section in shift.shifts_sections])
+              for shift in system.system_shifts]
+    return plain(system, system_pumps=[plain(pump) for pump in system.system_pumps],
+                 system_valves=[plain(valve) for valve in system.system_valves],
+                 system_sensors=[plain(sensor) for sensor in system.system_sensors], system_shifts=shifts)
+
+
+def system_snapshot(db: Session, system):
+    """ Page context of /system/{id} that is the same for every viewer, plain dicts shared between requests """
+    system = plain_system(system)
     red_sensors = []
     green_sensors = []
     blue_sensors = []
-    sensor_data = []
-    pump_flow_rate = []
-    pump_flow_date = []
     controlers = []
     used_valves = []
+    for sensor in system["system_sensors"]:
+        if sensor["readings"] < 50:
+            red_sensors.append(sensor)
+        elif sensor["readings"] >= 50 and sensor["readings"] < 80:
+            green_sensors.append(sensor)
+        else:
+            blue_sensors.append(sensor)
+    consumption_dates, pump_flow = devices.get_daily_consumption(
+        db=db, pump_ids=[pump["pump_id"] for pump in system["system_pumps"]], days=settings.system_consumption_days)
+    pump_flow_date = [date.strftime('%d-%m-%Y') for date in consumption_dates]
+    logs, _ = devices.get_system_logs(db=db, system_id=system["id"], limit=settings.system_log_limit)
+    logs = [dict(log._mapping) for log in logs]
+    sensor_ids = [sensor["sensor_id"] for sensor in system["system_sensors"]]
+    latest = devices.get_sensors_data(db=db, sensor_ids=sensor_ids)
+    for shift in system["system_shifts"]:
+        for section in shift["shifts_sections"]:
+            used_valves.append(section["valve_id"])
+            for controler in section["section_sensors"]:
+                controlers.append(controler)
+    return {"system": system, "red_sensors": red_sensors, "green_sensors": green_sensors, "blue_sensors": blue_sensors,
+            "pump_logs": [log for log in logs if log["dev_type"] == "pump"],
+            "valve_logs": [log for log in logs if log["dev_type"] == "valve"],
+            "sensor_logs": [log for log in logs if log["dev_type"] == "sensor"],
+            "sensor_data": [plain(latest[sensor_id]) for sensor_id in sensor_ids if sensor_id in latest],
+            "controlers": controlers, "used_valves": used_valves,
+            "pump_flow": json.dumps(pump_flow), "pump_date": json.dumps(pump_flow_date)}
+
+
+def system_members(system):
+    # Everything whose writes change the snapshot, see dashboard_cache invalidation in crud.devices
+    members = [("device", device.pump_id) for device in system.system_pumps]
+    members += [("device", device.valve_id) for device in system.system_valves]
+    members += [("device", device.sensor_id) for device in system.system_sensors]
+    for shift in system.system_shifts:
+        members.append(("shift", shift.id))
+        members += [("timer", timer.id) for timer in shift.shift_timers]
+        for section in shift.shifts_sections:
+            members.append(("section", section.id))
+            members += [("controler", controler.id) for controler in section.section_sensors]
+    return members
+
+
+@web_router.get("/system/{id}", dependencies=[Depends(query_budget(settings.system_query_budget))])
+def system(id: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
     week_days = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
     levels = [{"set_lvl_1": "Measure at 10 cm",
                "set_lvl_2": "Measure at 20 cm", "set_lvl_3": "Measure at 40 cm"}]
 
     if not current_user:
         return {"detail": "You are not logged in"}
-    system = devices.get_system(db=db, system_id=id)
-    for sensor in system.system_sensors:
-        if sensor.readings < 50:
-            red_sensors.append(sensor)
-        elif sensor.readings >= 50 and sensor.readings < 80:
-            green_sensors.append(sensor)
-        else:
-            blue_sensors.append(sensor)
-    if current_user.username != system.owner and not current_user.admin:
+    snapshot = dashboard_cache.get(id)
+    if snapshot is None:
+        version = dashboard_cache.version()
+        system = devices.get_system_topology(db=db, system_id=id)
+        if not system:
+            return {"detail": "There is no such system"}
+        snapshot = system_snapshot(db=db, system=system)
+        dashboard_cache.set(id, snapshot, system_members(system), version)
+    if current_user.username != snapshot["system"]["owner"] and not current_user.admin:
         return {"detail": "You are not authorized"}
-    for pump in system.system_pumps:
-        flow_data = devices.get_all_flow_data(
-            db=db, pump_id=pump.pump_id).all()
-        for data in flow_data:
-            pump_flow_rate.append(data.flow_rate)
-            pump_flow_date.append(data.date.strftime('%d-%m-%Y'))
-        if len(pump_flow_rate) > 7:
-            pump_flow_rate = pump_flow_rate[-7:]
-        if len(pump_flow_date) > 7:
-            pump_flow_date = pump_flow_date[-7:]
-        pumps_logs = devices.get_dev_logs(db=db, dev_id=pump.pump_id)
-        for pump_log in pumps_logs:
-            pump_logs.append(pump_log)
-    for valve in system.system_valves:
-        valves_logs = devices.get_dev_logs(db=db, dev_id=valve.valve_id)
-        for valve_log in valves_logs:
-            valve_logs.append(valve_log)
-    for sensor in system.system_sensors:
-        sensors_logs = devices.get_dev_logs(db=db, dev_id=sensor.sensor_id)
-        for sensor_log in sensors_logs:
-            sensor_logs.append(sensor_log)
-    for sensor in system.system_sensors:
-        data = devices.get_sensor_data(db=db, sensor_id=sensor.sensor_id)
-        sensor_data.append(data)
 
-    for shift in system.system_shifts:
-        for section in shift.shifts_sections:
-            used_valves.append(section.valve_id)
-            for controler in section.section_sensors:
-                controlers.append(controler)
+    return templates.TemplateResponse("system.html", {"request": request, **snapshot, "levels": levels, "week_days": week_days,
+                                                      **page_context(db=db, current_user=current_user)})
 
-    return templates.TemplateResponse("system.html", {"request": request, "system": system, "pump_logs": pump_logs, "valve_logs": valve_logs,
-                                                      "sensor_logs": sensor_logs, "current_user": current_user, "alerts": alerts, "red_sensors": red_sensors,
-                                                      "green_sensors": green_sensors, "blue_sensors": blue_sensors, "sensor_data": sensor_data, "levels": levels,
-                                                      "users": users, "controlers": controlers, "used_valves": used_valves, "week_days": week_days, "pump_flow": json.dumps(pump_flow_rate),
-                                                      "pump_date": json.dumps(pump_flow_date)})
+
+@web_router.get("/system/{id}/events")
+def system_events(id: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    if not current_user:
+        return {"detail": "You are not logged in"}
+    system = devices.get_system(db=db, system_id=id)
+    if not system:
+        return {"detail": "There is no such system"}
+    if current_user.username != system.owner and not current_user.admin:
+        return {"detail": "You are not authorized"}
+    device_ids = [pump.pump_id for pump in system.system_pumps]
+    device_ids += [valve.valve_id for valve in system.system_valves]
+    device_ids += [sensor.sensor_id for sensor in system.system_sensors]
+    # The stream outlives the request, don't hold a pooled connection for it
+    db.close()
+    return StreamingResponse(event_stream(request, device_ids, settings.live_keepalive),
+                             media_type="text/event-stream", headers={"Cache-Control": "no-cache"})